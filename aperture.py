@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""
+Aperture and fluence maps of computed leaf positions, projected back to the field plane.
+"""
+
+import zlib
+import struct
+import numpy as np
+from mlc_core import Projection, field_size_calc, leaf_layout, load_scale
+from machine_profiles import compile_profile
+
+
+def isocenter_positions(TransX, SSD, MLC_TransZ, dist_from_z_axis_to_inner_edge = 0, scale = load_scale):
+
+    """
+    A function that projects leaf TransX values of shape (..., 2, N_pairs), as written by
+    load_mlc_data(), back to the leaf pair positions (..., N_pairs, 2) in the plane of the
+    field. Use scale = 1 for the output of calculate_transx() with its default scale (GUI),
+    or Projection.positions() directly for calibrated machines.
+    """
+
+    return Projection(SSD, MLC_TransZ, dist_from_z_axis_to_inner_edge, scale).positions(TransX)
+
+def leaf_edges(number_of_leaf_pairs, SSD, MLC_TransZ, leaf_pitch = 2, profile = None):
+
+    """
+    A function that returns the lower and upper Y-edge (N_pairs x 2) of every leaf pair
+    in the plane of the field in cm, projected from the leaf TransY (mm). The left leaf
+    bank group is rotated by 180° about X, so pair i lies at -TransY[i]. With a machine
+    profile, every pair has the pitch of its zone.
+    """
+
+    TransY = -np.asarray(leaf_layout(number_of_leaf_pairs, leaf_pitch, profile)[0], dtype = float)
+    pitch = leaf_pitch if profile is None else compile_profile(profile)["pitch"]
+    unit = 10*field_size_calc(1, SSD, MLC_TransZ)                                                     #mm at the MLC to cm in the field plane
+
+    if unit == 0:
+        raise ValueError("MLC_TransZ must not be 0 to project the leaves to the field plane")
+
+    return np.stack([TransY - pitch/2, TransY + pitch/2], axis = -1)/unit
+
+def grid(extent = 20, resolution = 0.1):
+
+    """
+    A function that returns the pixel centres of a square grid from -extent to extent.
+    """
+
+    return np.arange(-extent + resolution/2, extent, resolution)
+
+def rasterize_apertures(positions, edges, x = None, y = None):
+
+    """
+    A function that rasterizes the apertures of leaf pair positions (..., N_pairs, 2) onto
+    the pixel centres x and y (default: grid()). edges holds the Y-edges of the leaf pairs,
+    see leaf_edges(). Returns a boolean array of shape (..., len(y), len(x)).
+    """
+
+    x = grid() if x is None else np.asarray(x, dtype = float)
+    y = grid() if y is None else np.asarray(y, dtype = float)
+
+    positions = np.sort(np.asarray(positions, dtype = float), axis = -1)
+    edges = np.asarray(edges, dtype = float)
+
+    row = (y[:, np.newaxis] >= edges[:, 0]) & (y[:, np.newaxis] < edges[:, 1])                       #Leaf pair covering each pixel row (len(y) x N_pairs)
+    covered = row.any(axis = 1)
+    pair = row.argmax(axis = 1)
+
+    lower = positions[..., pair, 0, np.newaxis]                                                       #Leaf positions for every pixel row (..., len(y) x 1)
+    upper = positions[..., pair, 1, np.newaxis]
+
+    return (lower <= x) & (x < upper) & covered[:, np.newaxis]
+
+def accumulate_fluence(positions, edges, weights = None, x = None, y = None, chunk_size = 256):
+
+    """
+    A function that accumulates the MU-weighted fluence of a control point sequence
+    (N_controlpoints x N_pairs x 2). Control points are rasterized in chunks to bound
+    the memory use. Without weights, every control point has a weight of 1.
+    """
+
+    positions = np.asarray(positions, dtype = float).reshape(-1, *np.shape(positions)[-2:])
+    weights = np.ones(len(positions)) if weights is None else np.asarray(weights, dtype = float)
+
+    fluence = 0
+
+    for start in range(0, len(positions), chunk_size):
+        apertures = rasterize_apertures(positions[start:start+chunk_size], edges, x, y)
+        fluence = fluence + np.tensordot(weights[start:start+chunk_size], apertures, axes = 1)
+
+    return fluence
+
+def save_npy(path, image):
+
+    """
+    A function that saves an aperture or fluence map as a .npy file.
+    """
+
+    np.save(path, np.asarray(image))
+    return
+
+def save_png(path, image):
+
+    """
+    A function that saves an aperture or fluence map as an 8-bit greyscale .png file,
+    scaled to its maximum, with +y at the top. Only uses the standard library.
+    """
+
+    image = np.asarray(image, dtype = float)[::-1]
+    peak = image.max() if image.size else 0
+    pixels = np.round(255*image/peak if peak > 0 else np.zeros_like(image)).astype(np.uint8)
+
+    height, width = pixels.shape
+    raw = b"".join(b"\x00" + row.tobytes() for row in pixels)                                         #Filter type 0 for every scanline
+
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xffffffff)
+
+    with open(path, "wb") as file:
+        file.write(b"\x89PNG\r\n\x1a\n")
+        file.write(chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 0, 0, 0, 0)))
+        file.write(chunk(b"IDAT", zlib.compress(raw)))
+        file.write(chunk(b"IEND", b""))
+
+    return
@@ -0,0 +1,333 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks and golden output checks of the MLC file generation.
+"""
+
+import os
+import sys
+import json
+import time
+import struct
+import hashlib
+import argparse
+import platform
+import tempfile
+import tracemalloc
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))                      #Modules of the tool are in the parent directory
+
+from mlc_core import machine_setup, load_mlc_data, load_control_points, calculate_transx, CreateTopasMLCFile, load_scale
+from leaf_stl import write_stl
+
+
+golden_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "golden.json")                 #SHA-256 of the generated files of every golden case
+
+default_pairs = [40, 60, 80, 120, 160]
+default_controlpoints = [1, 10, 100, 1000, 10000, 100000]
+
+def positions(number_of_controlpoints, number_of_leaf_pairs, seed = 0):
+
+    """
+    A function that returns reproducible leaf positions (N_controlpoints x N_pairs x 2) in cm.
+    """
+
+    rng = np.random.default_rng(seed)
+    return np.round(rng.uniform(-20, 20, (number_of_controlpoints, number_of_leaf_pairs, 2)), 2)
+
+def setup_for(number_of_leaf_pairs):
+
+    """
+    A function that returns a fixed machine configuration for number_of_leaf_pairs.
+    """
+
+    return dict(machine_setup(), leaf_stl_path = "leaf.stl", number_of_leaf_pairs = number_of_leaf_pairs, \
+        MLC_TransZ = 30, dist_from_xy_plane_to_top_edge = 1.5, dist_from_z_axis_to_inner_edge = 0.5, leaf_pitch = 2)
+
+###Golden Files###
+
+def golden_cases():
+
+    """
+    A function that returns the golden cases as {name: function writing the files and
+    returning their names}. All files are written into the current directory.
+    """
+
+    def static(n):
+        TransX = calculate_transx(positions(1, n, n)[0], 100, 30, 0.5)
+        CreateTopasMLCFile("static.txt", "leaf.stl", n, 1.5, 30, TransX.tolist())
+        return ["static.txt"]
+
+    def mode(name, n, controlpoints, **kwargs):
+        TransX = calculate_transx(positions(controlpoints, n, n), 100, 30, 0.5)
+        TransX = TransX[0].tolist() if name == "merged" else TransX                                  #A single control point
+        written = CreateTopasMLCFile(name + ".txt", "leaf.stl", n, 1.5, 30, TransX, mode = name, **kwargs)
+        return written if name == "include" else [name + ".txt"] + \
+            (["merged_left.stl", "merged_right.stl"] if name == "merged" else [])
+
+    def sequence(n, controlpoints):
+        np.save("input.npy", positions(controlpoints, n, n))
+        return load_mlc_data("input.npy", "sequence_{index:04d}.txt", setup = setup_for(n))
+
+    def rtplan(n, controlpoints):
+        leaf_positions = np.round(10*positions(controlpoints, n, n))                                 #Whole mm, exact in cm as well
+        cumulative = np.linspace(0, 1, controlpoints)
+        write_rtplan("plan.dcm", leaf_positions, cumulative, 100)
+        np.save("plan_cm.npy", leaf_positions/10)
+
+        written = load_mlc_data("plan.dcm", "rtplan_{index:04d}.txt", setup = setup_for(n))
+        reference = load_mlc_data("plan_cm.npy", "reference_{index:04d}.txt", setup = setup_for(n))
+
+        for filename, reference_filename in zip(written, reference):
+            with open(filename, "rb") as file, open(reference_filename, "rb") as reference_file:
+                if file.read() != reference_file.read():
+                    raise ValueError("RT Plan input differs from the same leaf positions in cm: " + filename)
+
+        if not np.allclose(load_control_points("plan.dcm", n, True)[1], np.diff(cumulative, append = 1)*100):
+            raise ValueError("RT Plan MU differ from the meterset weights of the plan")
+
+        return written
+
+    def profile():
+        TransX = calculate_transx(positions(1, 60, 60)[0], 100, 30, 0.5)
+        CreateTopasMLCFile("profile.txt", "leaf.stl", 60, 1.5, 30, TransX.tolist(), profile = "example_zones")
+        return ["profile.txt"]
+
+    cases = {"static_{}".format(n): (lambda n = n: static(n)) for n in default_pairs}
+    cases.update({
+        "dynamic_60x5": lambda: mode("dynamic", 60, 5),
+        "include_80x3": lambda: mode("include", 80, 3),
+        "merged_40x1": lambda: mode("merged", 40, 1),
+        "load_mlc_data_80x4": lambda: sequence(80, 4),
+        "rtplan_80x3": lambda: rtplan(80, 3),
+        "profile_60": profile,
+    })
+
+    return cases
+
+def leaf_mesh():
+
+    """
+    A function that writes a small box-shaped leaf mesh to leaf.stl for the merged mode.
+    """
+
+    corners = np.array([[x, y, z] for x in (0, 100) for y in (-1, 1) for z in (0, 60)], dtype = float)
+    faces = [(0, 1, 3), (0, 3, 2), (4, 6, 7), (4, 7, 5), (0, 4, 5), (0, 5, 1), \
+        (2, 3, 7), (2, 7, 6), (0, 2, 6), (0, 6, 4), (1, 5, 7), (1, 7, 3)]
+    write_stl("leaf.stl", corners[np.array(faces)])
+
+def write_rtplan(path, leaf_positions, cumulative_meterset_weight, mu):
+
+    """
+    A function that writes a minimal DICOM RT Plan (explicit VR little endian) with one
+    beam of MLCX leaf positions (N_controlpoints x N_pairs x 2) in mm.
+    """
+
+    def element(tag, vr, value):
+        value = value.encode() if isinstance(value, str) else value
+        value += b" "*(len(value) % 2)                                                                #Values have an even length
+        return struct.pack("<HH2sH", tag[0], tag[1], vr, len(value)) + value
+
+    def sequence(tag, items):
+        data = struct.pack("<HH2sHI", tag[0], tag[1], b"SQ", 0, 0xFFFFFFFF)
+        for item in items:
+            data += struct.pack("<HHI", 0xFFFE, 0xE000, 0xFFFFFFFF) + item + struct.pack("<HHI", 0xFFFE, 0xE00D, 0)
+        return data + struct.pack("<HHI", 0xFFFE, 0xE0DD, 0)
+
+    def numbers(values):
+        return "\\".join("{:g}".format(value) for value in values)
+
+    controlpoints = [element((0x300A, 0x0112), b"IS", str(c)) + \
+        element((0x300A, 0x0134), b"DS", "{:g}".format(weight)) + \
+        sequence((0x300A, 0x011A), [element((0x300A, 0x00B8), b"CS", "MLCX") + \
+            element((0x300A, 0x011C), b"DS", numbers(np.concatenate([bank_a, bank_b])))]) \
+        for c, (weight, (bank_a, bank_b)) in enumerate(zip(cumulative_meterset_weight, np.moveaxis(leaf_positions, -1, 1)))]
+
+    with open(path, "wb") as file:
+        file.write(b"\0"*128 + b"DICM" + element((0x0002, 0x0010), b"UI", "1.2.840.10008.1.2.1\0"))
+        file.write(sequence((0x300A, 0x0070), [sequence((0x300C, 0x0004), \
+            [element((0x300C, 0x0006), b"IS", "1") + element((0x300A, 0x0086), b"DS", "{:g}".format(mu))])]))
+        file.write(sequence((0x300A, 0x00B0), [element((0x300A, 0x00C0), b"IS", "1") + \
+            element((0x300A, 0x010E), b"DS", "1") + sequence((0x300A, 0x0111), controlpoints)]))
+
+def golden_hashes():
+
+    """
+    A function that runs all golden cases in a temporary directory and returns the
+    SHA-256 hash of every written file, {case: [hash, ...]}.
+    """
+
+    directory = os.getcwd()
+    hashes = {}
+
+    with tempfile.TemporaryDirectory() as temporary:
+        os.chdir(temporary)                                                                           #Relative file names, so the output does not depend on the location
+
+        try:
+            leaf_mesh()
+
+            for name, case in golden_cases().items():
+                hashes[name] = []
+                for filename in case():
+                    with open(filename, "rb") as file:
+                        hashes[name] += [hashlib.sha256(file.read()).hexdigest()]
+
+        finally:
+            os.chdir(directory)
+
+    return hashes
+
+def check_golden(update = False):
+
+    """
+    A function that compares the generated files with the golden hashes and returns the
+    names of the cases that differ. With update, the golden hashes are rewritten instead.
+    """
+
+    hashes = golden_hashes()
+
+    if update:
+        with open(golden_path, "w") as file:
+            json.dump(hashes, file, indent = 2, sort_keys = True)
+        return []
+
+    with open(golden_path) as file:
+        golden = json.load(file)
+
+    return sorted(name for name in set(golden) | set(hashes) if golden.get(name) != hashes.get(name))
+
+###Benchmarks###
+
+def measure(function, repeat = 3):
+
+    """
+    A function that returns the best run time of function in seconds and the peak
+    memory allocated during a separate, traced run in bytes.
+    """
+
+    seconds = min(_timed(function) for _ in range(repeat))
+
+    tracemalloc.start()
+    try:
+        function()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    return seconds, peak
+
+def _timed(function):
+
+    start = time.perf_counter()
+    function()
+    return time.perf_counter() - start
+
+def benchmark(pairs = default_pairs, controlpoints = default_controlpoints, max_files = 1000, repeat = 3):
+
+    """
+    A function that times the TransX computation, CreateTopasMLCFile() and load_mlc_data()
+    separately for every number of leaf pairs and control points. Writing is limited to
+    max_files files per measurement; load_mlc_data() is skipped for longer sequences.
+    Returns a list of results with run time, throughput (control points per second) and
+    peak memory.
+    """
+
+    results = []
+    directory = os.getcwd()
+
+    with tempfile.TemporaryDirectory() as temporary:
+        os.chdir(temporary)
+
+        try:
+            for n in pairs:
+                setup = setup_for(n)
+
+                for c in controlpoints:
+                    leaf_positions = positions(c, n)
+                    TransX = calculate_transx(leaf_positions, setup["SSD"], setup["MLC_TransZ"], \
+                        setup["dist_from_z_axis_to_inner_edge"], load_scale)
+                    written = min(c, max_files)
+
+                    def write():
+                        for i in range(written):
+                            CreateTopasMLCFile("write.txt", "leaf.stl", n, 1.5, 30, TransX[i].tolist())
+
+                    stages = [("transx", c, lambda: calculate_transx(leaf_positions, setup["SSD"], \
+                        setup["MLC_TransZ"], setup["dist_from_z_axis_to_inner_edge"], load_scale)), \
+                        ("CreateTopasMLCFile", written, write)]
+
+                    if c <= max_files:
+                        np.save("input.npy", leaf_positions)
+                        stages += [("load_mlc_data", c, lambda: load_mlc_data("input.npy", "load.txt", setup = setup))]
+
+                    for stage, count, function in stages:
+                        seconds, peak = measure(function, repeat)
+                        results += [{"stage": stage, "number_of_leaf_pairs": n, "controlpoints": c, \
+                            "measured_controlpoints": count, "seconds": seconds, \
+                            "controlpoints_per_second": count/seconds if seconds else None, "peak_memory": peak}]
+                        print("{:<20}{:>5} pairs {:>7} control points {:>12.6f} s {:>12.0f} cp/s {:>8.1f} MiB".format( \
+                            stage, n, c, seconds, count/seconds if seconds else 0, peak/2**20))
+
+        finally:
+            os.chdir(directory)
+
+    return results
+
+def compare(results, previous):
+
+    """
+    A function that prints the run time of every result relative to a previous result file.
+    """
+
+    with open(previous) as file:
+        before = {(r["stage"], r["number_of_leaf_pairs"], r["controlpoints"]): r for r in json.load(file)["results"]}
+
+    for r in results:
+        old = before.get((r["stage"], r["number_of_leaf_pairs"], r["controlpoints"]))
+        if old and old["seconds"]:
+            print("{:<20}{:>5} pairs {:>7} control points {:>8.2f}x time {:>8.2f}x memory".format(r["stage"], \
+                r["number_of_leaf_pairs"], r["controlpoints"], r["seconds"]/old["seconds"], \
+                r["peak_memory"]/old["peak_memory"] if old["peak_memory"] else float("nan")))
+
+def main(argv = None):
+
+    """
+    Command line entry point: checks the golden files, then runs the benchmarks and saves
+    the results to a JSON file.
+    """
+
+    parser = argparse.ArgumentParser(description = "Benchmark the MLC file generation and check the golden files.")
+    parser.add_argument("-o", "--output", default = "benchmark_results.json", help = "JSON file for the results")
+    parser.add_argument("-p", "--pairs", type = int, nargs = "+", default = default_pairs)
+    parser.add_argument("-c", "--controlpoints", type = int, nargs = "+", default = default_controlpoints)
+    parser.add_argument("--max-files", type = int, default = 1000, help = "maximum number of files written per measurement")
+    parser.add_argument("--repeat", type = int, default = 3, help = "runs per measurement, the best one counts")
+    parser.add_argument("--compare", help = "previous result file to compare with")
+    parser.add_argument("--golden-only", action = "store_true", help = "only check the golden files")
+    parser.add_argument("--update-golden", action = "store_true", help = "rewrite the golden hashes after an intended change")
+    args = parser.parse_args(argv)
+
+    differences = check_golden(args.update_golden)
+
+    if differences:
+        print("Output differs from the golden files: " + ", ".join(differences))
+        return 1
+
+    print("Golden files " + ("updated" if args.update_golden else "identical"))
+
+    if args.golden_only:
+        return 0
+
+    results = benchmark(args.pairs, args.controlpoints, args.max_files, args.repeat)
+
+    with open(args.output, "w") as file:
+        json.dump({"python": platform.python_version(), "numpy": np.__version__, "machine": platform.machine(), \
+            "time": time.strftime("%Y-%m-%d %H:%M:%S"), "results": results}, file, indent = 2)
+
+    if args.compare:
+        compare(results, args.compare)
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -9,74 +9,71 @@ Created on Fri Nov 26 12:41:44 2021
 
 import sys
 import numpy as np
-import tkinter as tk
-import tkinter.ttk as ttk
-from custom_mlc_creator_functions import *
+from mlc_core import *                                                                                                #GUI components are only imported when the GUI starts
 
 ###################SETUP###################
 
 leaf_stl_path = ""                                                                                                    #Path to single leaf .stl file
-number_of_leaf_pairs = 64                                                                                             #Amount of leaf pairs in MLC configuration (Max to render: 64)
+number_of_leaf_pairs = 64                                                                                             #Amount of leaf pairs in MLC configuration
 MLC_TransZ = 0 #cm                                                                                                    #Translation distance of whole MLC along Z
 SSD = 100 #cm                                                                                                         #Source-Surface-Distance
-dist_from_xy_plane_to_top_edge = 0 #mm                                                                                #Correction amount from stl coordinates to TOPAS (z-axis)
-dist_from_z_axis_to_inner_edge = 0 #mm                                                                                #Correction amount from stl coordinates to TOPAS (x/y-axis)
+dist_from_xy_plane_to_top_edge = None #mm                                                                             #Correction amount from stl coordinates to TOPAS (z-axis), None: measure from .stl
+dist_from_z_axis_to_inner_edge = None #mm                                                                             #Correction amount from stl coordinates to TOPAS (x/y-axis), None: measure from .stl
+leaf_pitch = None #mm                                                                                                 #Spacing between neighbouring leaves (TransY), None: measure from .stl
+leaf_end = None                                                                                                       #Rounded leaf end calibration table (cm), see Projection
+pair_offset = None                                                                                                    #Leaf tip calibration table per leaf pair (cm), see Projection
 
 ###########################################
 
 ##################PRESETS##################
 
-sine = [[5 + 10*np.sin(i*np.pi/15),-5 +10*np.sin(i*np.pi/15)] for i in range(-32,32)]                                 #Preset for a sinusoid field
-wave = [[10*np.cos(i*np.pi/15),-10*np.cos(i*np.pi/15)] for i in range(-32,32)] + [[0,0] for i in range(0)]            #Preset for a wave field
-zigzag = [[-5,5] if i%2==0 else  [0,0] for i in range(-32,32) ]                                                       #Preset for a open-close-open-close field
-diag = [[i*0.5-2.5,i*0.5+2.5] for i in range(-32,32)]                                                                 #Preset for a diagonal field
+def presets(number_of_leaf_pairs = 64):
+
+    """
+    Function that creates the field presets for all leaf pairs, only needed once the GUI starts.
+    """
+
+    pairs = range(-(number_of_leaf_pairs//2), number_of_leaf_pairs - number_of_leaf_pairs//2)
+
+    sine = [[5 + 10*np.sin(i*np.pi/15),-5 +10*np.sin(i*np.pi/15)] for i in pairs]                                     #Preset for a sinusoid field
+    wave = [[10*np.cos(i*np.pi/15),-10*np.cos(i*np.pi/15)] for i in pairs] + [[0,0] for i in range(0)]                #Preset for a wave field
+    zigzag = [[-5,5] if i%2==0 else  [0,0] for i in pairs ]                                                           #Preset for a open-close-open-close field
+    diag = [[i*0.5-2.5,i*0.5+2.5] for i in pairs]                                                                     #Preset for a diagonal field
+
+    return sine, wave, zigzag, diag
 
 ###################SETUP###################
 
 def CalculateLeafPositions(leaf_num, leaf_stl_path, number_of_leaf_pairs, MLC_TransZ, SSD, \
-    dist_from_xy_plane_to_top_edge, dist_from_z_axis_to_inner_edge, root):
+    dist_from_xy_plane_to_top_edge, dist_from_z_axis_to_inner_edge, root, leaf_pitch = None, leaf_end = None, \
+    pair_offset = None):
     
     """
     Function that calculates the correct MLC positioning in the simulated coordinate system. 
     Uses the specified field_size_calc() function to transform the desired field size into
     the opening distance of each leaf. Standard setup uses the intercept theorem, however
-    this function can be replaced as necessary.
+    this function can be replaced as necessary. The leaf_end and pair_offset tables
+    calibrate the projection for real leaf designs, see Projection.
 
     Calls the imported CreateTopasMLCFile() function to create the build MLC simulation file.
     """
 
-    global sliders
-
-    if number_of_leaf_pairs >= leaf_num:                                                                              #Since only 64 leaves fit on screen, set the position
-                                                                                                                      #of all others to 0 if more exist
-        leafpositions_left = [-dist_from_z_axis_to_inner_edge for i in range(0,(number_of_leaf_pairs-leaf_num)//2)]   
-        leafpositions_right = [-dist_from_z_axis_to_inner_edge for i in range(0,(number_of_leaf_pairs-leaf_num)//2)]  
+    global editor
 
-    for leafslider in sliders:
+    dist_from_xy_plane_to_top_edge, dist_from_z_axis_to_inner_edge, leaf_pitch = calibrate_from_stl(leaf_stl_path, \
+        dist_from_xy_plane_to_top_edge, dist_from_z_axis_to_inner_edge, leaf_pitch)                                   #Measure offsets left as None from the .stl file
 
-        slidervalues         = sorted(leafslider.slider.getValues())                                                  #Read desired leaf positions from the slider positions
+    slidervalues = np.array(editor.getValues(), dtype=float)[:leaf_num]                                               #Read desired leaf positions from the editor
 
-        field_size = abs(slidervalues[1]-slidervalues[0])                                                             #Calculate the field size from the two positions
-        offset = (slidervalues[1]+slidervalues[0])/2                                                                  #Calculate the centre-axis-offset from the two positions
+    hidden = max(number_of_leaf_pairs-leaf_num, 0)                                                                    #Set the position of leaf pairs that
+    slidervalues = np.pad(slidervalues, ((hidden//2, hidden-hidden//2), (0, 0)))                                      #were not edited to 0
 
-        pos_right = field_size_calc(offset+field_size/2, SSD, MLC_TransZ)                                             #Calculate the according distance from the centre axis
-        pos_left = field_size_calc(-offset+field_size/2, SSD, MLC_TransZ)                                             #for both leaves
-
-        leafpositions_left  += [round(-(dist_from_z_axis_to_inner_edge+pos_left),3)]                                 #Set the according positions of the leaves while accounting
-        leafpositions_right += [round(-(dist_from_z_axis_to_inner_edge+pos_right),3)]                                #for differences between the two coordinate systems
-
-    if number_of_leaf_pairs >= leaf_num:                                                                             #Since only 64 leaves fit on screen, set the position
-                                                                                                                     #of all others to 0 if more exist
-        leafpositions_left += [-dist_from_z_axis_to_inner_edge for i in range(number_of_leaf_pairs-\
-            (number_of_leaf_pairs-leaf_num)//2,number_of_leaf_pairs)]                                                 
-
-        leafpositions_right += [-dist_from_z_axis_to_inner_edge for i in range(number_of_leaf_pairs-\
-            (number_of_leaf_pairs-leaf_num)//2,number_of_leaf_pairs)]                                                 
-
-    leafpositions_right.reverse()                                                                                    #Account for the 180° rotation of the leaf bank placement
+    projection = Projection(SSD, MLC_TransZ, dist_from_z_axis_to_inner_edge, leaf_end = leaf_end, \
+        pair_offset = pair_offset)
+    TransX = projection.transx(slidervalues)                                                                          #Calculate the according distance from the centre axis for both leaves
 
     CreateTopasMLCFile("Custom_MLC.txt", leaf_stl_path, number_of_leaf_pairs, \
-        dist_from_xy_plane_to_top_edge, MLC_TransZ, [leafpositions_left,leafpositions_right])                        #Write TOPAS simulation file
+        dist_from_xy_plane_to_top_edge, MLC_TransZ, TransX.tolist(), leaf_pitch = leaf_pitch)                         #Write TOPAS simulation file
 
     root.destroy()                                                                                                   #Close after job
     
@@ -88,29 +85,27 @@ def main():
     Function that defines the GUI and its components to customize a MLC for a TOPAS simulation. 
     """
 
-    if number_of_leaf_pairs >=64:
-        number_of_rendered_leafs = 64
-    else:
-        number_of_rendered_leafs = number_of_leaf_pairs
-    
-    global sliders 
+    import tkinter as tk                                                                                              #Import the GUI components only when needed
+    import tkinter.ttk as ttk
+    from custom_mlc_creator_functions import LeafModel, LeafEditor
+
+    sine, wave, zigzag, diag = presets(number_of_leaf_pairs)
+
+    global editor 
     
     def choose_preset(root, preset=None):
         
         """
-        A function that sets all available sliders to a desired field size.
+        A function that sets all leaf pairs to a desired field size.
         """
         
-        global sliders
-
         try: 
             if preset == None:                                                                                        #Check if preset was selected           
-                x = float(e1.get())/2                                                                                 #Read value from entry field
+                x = float(e1.get())                                                                                   #Read value from entry field
                 e1.delete(0, 'end')                                                                                   #Clear entry field for next entry
-                preset = [[-x,x] for i in range(-int(len(sliders)/2),int(len(sliders)/2))]                            #Create the desired field size preset list
-                
-            [slider.slider.destroy() for slider in sliders]                                                           #Rebuild the sliders with the desired field size
-            sliders = [LeafSlider(root,i,preset[i]) for i in range(len(sliders))]
+                model.setField(x)                                                                                     #Open all leaf pairs to the desired field size
+            else:
+                model.setValues(preset)                                                                               #Set all leaf pairs to the preset
         except Exception:
             pass
         return
@@ -118,28 +113,26 @@ def main():
     def move_field(root):
 
         """
-        A function that moves the field positions of all sliders by a specified offset.
+        A function that moves the field positions of all leaf pairs by a specified offset.
         """
         
-        global sliders
-        
-        cur_pos = [slider.slider.getValues() for slider in sliders]                                                   #Get the current values
-    
         x = float(e2.get())                                                                                           #Read value from entry field
         if x >= 20:                                                                                                   #Maximum allowed field size : 40x40
             return
         
         e2.delete(0, 'end')                                                                                           #Clear entry field for next entry
 
-        for pos in cur_pos:                                                                                           #Add desired offset to each slider
-            pos[0] += x
-            pos[1] += x
-            
-        if np.max(cur_pos) > 20 or np.min(cur_pos) < -20:                                                             #Maximum allowed field size : 40x40
-               return
-          
-        [slider.slider.destroy() for slider in sliders]                                                               #Rebuild the sliders with the desired field position
-        sliders = [LeafSlider(root,i,cur_pos[i]) for i in range(len(sliders))]
+        model.shift(x)                                                                                                #Add desired offset to each leaf, unless a leaf would
+        return                                                                                                        #leave the maximum allowed field size : 40x40
+
+    def set_selected():
+
+        """
+        A function that sets the selected leaf pairs to the typed positions.
+        """
+
+        if editor.setSelected(e3.get()):
+            e3.delete(0, 'end')
         return
     
     ###ROOT GEOMETRY###
@@ -147,19 +140,23 @@ def main():
     root = tk.Tk()
     root.geometry('900x1070+0+0')
     root.resizable(False, True)
-    root.title('MLC Konfiguration - Mittlere 64 Leafs')    
-    sliders = [LeafSlider(root,i,zigzag[i]) for i in range(number_of_rendered_leafs)]
+    root.title('MLC Konfiguration - {} Leafpaare'.format(number_of_leaf_pairs))    
+    model = LeafModel(zigzag)                                                                                         #Positions of all leaf pairs, observed by the editor
+    editor = LeafEditor(root, model)                                                                                  #One canvas for all leaf pairs, drawing only the visible rows
+    editor.place(x=0, y=40, relheight=1, height=-50)
     fieldsize = tk.StringVar(root)
     offset = tk.StringVar(root)
+    selection = tk.StringVar(root)
     
     ###ROOT BUTTONS###
 
-    button = ttk.Button(root, text="Konfigurieren!", command=lambda:CalculateLeafPositions(number_of_rendered_leafs, leaf_stl_path,\
-         number_of_leaf_pairs, MLC_TransZ, SSD, dist_from_xy_plane_to_top_edge, dist_from_z_axis_to_inner_edge, root))
+    button = ttk.Button(root, text="Konfigurieren!", command=lambda:CalculateLeafPositions(number_of_leaf_pairs, leaf_stl_path,\
+         number_of_leaf_pairs, MLC_TransZ, SSD, dist_from_xy_plane_to_top_edge, dist_from_z_axis_to_inner_edge, root, leaf_pitch, \
+         leaf_end, pair_offset))
     button.pack()
     button.place(x=535, y=10)
     
-    button1 = ttk.Button(root, width = 19, text="Eingabe übernehmen!", command=lambda:set_vals(sliders))
+    button1 = ttk.Button(root, width = 19, text="Eingabe übernehmen!", command=set_selected)
     button1.pack()
     button1.place(x=760, y=10)
     
@@ -186,6 +183,14 @@ def main():
     button7 = ttk.Button(root, text="cm Verschiebung", width = 16, command=lambda:move_field(root))
     button7.pack()
     button7.place(x=141, y=10)
+
+    button8 = ttk.Button(root, width = 2, text="+", command=lambda:editor.zoom(1.25))                                 #Zoom the leaf rows
+    button8.pack()
+    button8.place(x=640, y=10)
+
+    button9 = ttk.Button(root, width = 2, text="-", command=lambda:editor.zoom(0.8))
+    button9.pack()
+    button9.place(x=675, y=10)
     
     ###ENTRY FIELDS###
     
@@ -196,15 +201,17 @@ def main():
     e2 = tk.Entry(root, width = 3, textvariable = offset)
     e2.pack()
     e2.place(x=115, y=13)
+
+    e3 = tk.Entry(root, width = 18, textvariable = selection)                                                        #Positions for the selected leaf pairs, e.g. "-5 5"
+    e3.pack()
+    e3.place(x=775, y=45)
     
     root.focus_force()
     root.mainloop()
 
 if __name__ == "__main__":
 
-    try:
-        fn = sys.argv[1]                                                                                              #Command line functionality to load a .txt file with 
-        load_mlc_data(fn)                                                                                             #position presets. Else start GUI.
-        exit()
-    except IndexError:   
+    if len(sys.argv) > 1:                                                                                             #Command line functionality to load a file with 
+        sys.exit(cli())                                                                                               #position presets, see mlc_core.cli(). Else start GUI.
+    else:
         main()
\ No newline at end of file
@@ -8,224 +8,423 @@ Created on Fri Nov 24 16:21:35 2021
 """
 
 import re
-import os
 import numpy as np
 import tkinter as tk
 from tkSliderWidget import Slider
+from mlc_core import *                                                                                #Geometry math and file writing, kept free of GUI imports
 
 
-###TOPAS Simulation File Format with Blanks###
-
-materials = '\
-#==========================MATERIALS==========================#\n\n\
-sv:Ma/LeafMaterial/Components   = 3 "Tungsten" "Nickel" "Iron"\n\
-uv:Ma/LeafMaterial/Fractions 	= 3 0.95 00.0375 0.0125\n\
-d:Ma/LeafMaterial/Density       = 18 g/cm3\n\n'
-
-mlcgroup = '\
-#=================MLC GROUP===============#\n\n\
-s:Ge/MLCGroup/Type              = "Group"\n\
-s:Ge/MLCGroup/Parent        	= "World"\n\
-d:Ge/MLCGroup/TransZ            = {} cm\n\n' 
-
-placement_left = '\
-#===============PLACEMENT GROUP=============#\n\n\
-s:Ge/LeftGroup/Type 	    	= "Group"\n\
-s:Ge/LeftGroup/Parent       	= "MLCGroup"\n\
-d:Ge/LeftGroup/RotX             = 180 deg\n\
-d:Ge/LeftGroup/TransZ	    	= {} mm\n\n' 
-
-placement_right = '\
-s:Ge/RightGroup/Type        	= "Group"\n\
-s:Ge/RightGroup/Parent 	    	= "MLCGroup"\n\
-d:Ge/RightGroup/RotY 	    	= 180 deg\n\
-d:Ge/RightGroup/TransZ	    	= {} mm\n\n\
-#===================COMPONENTS===============#\n\n' 
-
-left_leaf_parameters    = '\
-s:Ge/LeftLeaf{}/Type             = "TsCAD"\n\
-s:Ge/LeftLeaf{}/Parent           = "LeftGroup"\n\
-s:Ge/LeftLeaf{}/Material         = "LeafMaterial"\n\
-d:Ge/LeftLeaf{}/TransX           = {} mm\n\
-d:Ge/LeftLeaf{}/TransY           = {} mm\n\
-d:Ge/LeftLeaf{}/TransZ           = {} cm\n\
-d:Ge/LeftLeaf{}/RotX             = {} deg\n\
-s:Ge/LeftLeaf{}/DrawingStyle     = "Solid"\n\
-s:Ge/LeftLeaf{}/InputFile        = "{}"\n\
-s:Ge/LeftLeaf{}/FileFormat       = "stl" \n\
-d:Ge/LeftLeaf{}/Units            = 1 mm\n\
-s:Ge/LeftLeaf{}/Color            = {}\n\n'
-
-right_leaf_parameters   = '\
-s:Ge/RightLeaf{}/Type            = "TsCAD"\n\
-s:Ge/RightLeaf{}/Parent          = "RightGroup"\n\
-s:Ge/RightLeaf{}/Material        = "LeafMaterial"\n\
-d:Ge/RightLeaf{}/TransX          = {} mm\n\
-d:Ge/RightLeaf{}/TransY          = {} mm\n\
-d:Ge/RightLeaf{}/TransZ          = {} cm\n\
-d:Ge/RightLeaf{}/RotX            = {} deg\n\
-s:Ge/RightLeaf{}/DrawingStyle    = "Solid"\n\
-s:Ge/RightLeaf{}/InputFile       = "{}"\n\
-s:Ge/RightLeaf{}/FileFormat      = "stl"\n\
-d:Ge/RightLeaf{}/Units           = 1 mm\n\
-s:Ge/RightLeaf{}/Color           = {}\n\n'
-
-def load_mlc_data(input):
+def parse_pair(input):
 
     """
-    A function that loads specified MLC leaf positions from a
-    numpy .txt file and creates the according simulation file.
+    A function that reads the two leaf positions of a pair from a typed text, e.g. "-5 5".
+    Returns None if the text does not contain exactly two numbers.
     """
 
-    ###################SETUP###################
+    negint = re.findall(r"-[0-9]+", input)
+    b = re.findall(r"[-+]?\d*\.\d+|\d+", input)
+    for num in negint:
+        for flt in b:
+            if float(num) == - float(flt):
+                b.remove(flt)
+    b += negint
 
-    leaf_stl_path = ""                                                                                #Path to single leaf .stl file
-    number_of_leaf_pairs = 80                                                                         #Amount of leaf pairs in MLC configuration
-    MLC_TransZ = 0 #cm                                                                                #Translation distance of whole MLC along Z
-    SSD = 100 #cm                                                                                     #Source-Surface-Distance
-    dist_from_xy_plane_to_top_edge = 0 #mm                                                            #Correction amount from stl coordinates to TOPAS (z-axis)
-    dist_from_z_axis_to_inner_edge = 0 #mm                                                            #Correction amount from stl coordinates to TOPAS (x/y-axis)
-   
-    ###########################################
+    if len(b)!= 2:
+        return None
 
-    if os.path.exists(input) != True:
-        return
-    
-    leaf_positions = np.loadtxt(input)                                                                #Load .txt file and initialize lists for the leaf banks
-    leaf_positions = leaf_positions.tolist()
-    leafpositions_left = []
-    leafpositions_right = []
+    return [float(b[0]),float(b[1])]
 
-    for value in leaf_positions:                                            
+class LeafModel:
 
-        value = sorted(value)                                                                         #Assing value to correct leaf bank
+    """
+    A class holding the positions of all leaf pairs (N_pairs x 2) as a NumPy array. Presets,
+    shifts and typed values are array operations; observers are called with the changed
+    rows (None: all rows) after every change.
+    """
 
-        if value[0] != 0:
-            pos_left  = 2*value[0]/abs(value[0])*field_size_calc(abs(value[0]), SSD, MLC_TransZ)      #Field size calculation, special case for size 0
-        
-        else:
-            pos_left = 0
+    def __init__(self, values, min_val = -20, max_val = 20):
 
-        if value[1] != 0:
+        self.min_val = min_val
+        self.max_val = max_val
+        self.values = np.clip(np.array(values, dtype = float).reshape(-1, 2), min_val, max_val)     #Leaf positions (N_pairs x 2)
+        self.observers = []
 
-            pos_right = -2*value[1]/abs(value[1])*field_size_calc(abs(value[1]),SSD, MLC_TransZ)      #Field size calculation, special case for size 0
-        else:
-            pos_right = 0
+    def __len__(self):
 
-        leafpositions_left  += [round(-(dist_from_z_axis_to_inner_edge-pos_left),3)]                  #Account for the 180° rotation of the leaf bank placement
-        leafpositions_right += [round(-(dist_from_z_axis_to_inner_edge-pos_right),3)]
+        return len(self.values)
 
-    leafpositions_right.reverse()    
-    TransX = [leafpositions_left, leafpositions_right]
-    
-    CreateTopasMLCFile("DICOM_MLC_POS.txt", leaf_stl_path, number_of_leaf_pairs, MLC_TransZ, TransX)  #Write TOPAS simulation file 
+    def subscribe(self, observer):
 
-    return
+        """
+        A method that registers a function called as observer(rows) after every change.
+        """
 
-def field_size_calc(field_size, SSD, TransZ):
+        self.observers.append(observer)
 
-    """
-    A function that calculates the desired field size using the intercept theorem.
-    """
+    def _notify(self, rows = None):
 
-    return (TransZ/SSD) *field_size
+        for observer in self.observers:
+            observer(rows)
 
-def CreateTopasMLCFile(filename: str, leaf_stl_path: str, number_of_leaf_pairs: int, \
-    dist_from_xy_plane_to_top_edge: int, MLC_TransZ: int, TransX: list, \
-    materials = materials, mlcgroup = mlcgroup, placement_left = placement_left, \
-    placement_right = placement_right): 
+    def getValues(self):
 
-    """
-    A function that uses the specified parameters to create a TOPAS-readable simulation file
-    for a MLC. Needs a .stl (3D) file describing one leaf and the desired positioning info
-    to the place many of these in the correct positions.
-    """
+        """
+        A method that returns the positions of all leaf pairs, rounded like Slider.getValues().
+        """
 
-    TransY  = [2*i+2/2 for i in range(-int(number_of_leaf_pairs/2),int(number_of_leaf_pairs/2))]      #Space between leaves
-    TransYR = TransY                                                                                  #Identical for both leaf banks
-    TransZ  = [0 for i in range(-int(number_of_leaf_pairs/2),int(number_of_leaf_pairs/2))]            #Rotation correction - example: [5*np.cos(0.005*i) for i in range(-int(number_of_leaf_pairs/2),int(number_of_leaf_pairs/2))]
-    RotX    = [180 for i in range(number_of_leaf_pairs)]                                              #Leaf angles - example: np.linspace(168,192,number_of_leaf_pairs).tolist()
+        return np.round(self.values, 1).tolist()
 
-    RotXR = RotX                                                                                      #Identical for both leaf banks
+    def setValues(self, values):
 
-    leftcolors  = ['"Grey080"','"Grey160"']*int(number_of_leaf_pairs/2)                               #Alternating color scheme for leaves                                              
-    rightcolors  = ['"Grey080"','"Grey160"']*int(number_of_leaf_pairs/2)
+        """
+        A method that replaces the positions of all leaf pairs, e.g. by a preset.
+        """
 
-    leaf_num = number_of_leaf_pairs
+        self.values = np.clip(np.array(values, dtype = float).reshape(-1, 2), self.min_val, self.max_val)
+        self._notify()
 
-    with open(filename,"w+") as file:   
+    def setField(self, field_size):
 
-        file.writelines(materials)                                                                    #Write header containing the MLC group information, materials etc.
-        file.writelines(mlcgroup.format(MLC_TransZ))
-        file.writelines(placement_left.format(dist_from_xy_plane_to_top_edge))
-        file.writelines(placement_right.format(dist_from_xy_plane_to_top_edge))
+        """
+        A method that opens all leaf pairs to a symmetric field of field_size.
+        """
 
-        for i in range(leaf_num):                                                                     #Write the position of each individual leaf
-            file.writelines(left_leaf_parameters.format(i,i,i,i,TransX[0][i],i,TransY[i], \
-                i,TransZ[i],i,RotX[i],i,i,leaf_stl_path,i,i,i,leftcolors[i]))
+        self.values[:] = np.clip([-field_size/2, field_size/2], self.min_val, self.max_val)
+        self._notify()
 
-            file.writelines(right_leaf_parameters.format(i,i,i,i,TransX[1][leaf_num-1-i], \
-                i,TransYR[leaf_num-1-i],i,TransZ[leaf_num-1-i],i,RotXR[leaf_num-1-i],i,i, \
-                leaf_stl_path,i,i,i,rightcolors[i]))
+    def shift(self, offset):
 
-    return
+        """
+        A method that moves all leaves by offset. Returns False, without moving any leaf,
+        if a leaf would leave the allowed range.
+        """
 
-def set_vals(sliders):
+        shifted = self.values + offset
 
-    """
-    A function that sets a LeafSlider to a specified value.
-    """
+        if shifted.max() > self.max_val or shifted.min() < self.min_val:
+            return False
+
+        self.values = shifted
+        self._notify()
+
+        return True
+
+    def setRows(self, rows, pair):
+
+        """
+        A method that sets the leaf pairs in rows to a pair of positions.
+        """
+
+        rows = sorted(rows)
+        self.values[rows] = np.clip(pair, self.min_val, self.max_val)
+        self._notify(rows)
+
+    def setLeaf(self, row, bank, value):
 
-    for slider in sliders:
-        slider.update_val()
-        slider.entry.delete(0, 'end')
-    return
+        """
+        A method that sets a single leaf.
+        """
+
+        self.values[row, bank] = min(max(value, self.min_val), self.max_val)
+        self._notify([row])
 
-class LeafSlider(Slider):
+class LeafEditor:
 
     """
-    A class describing selector with two sliders, imitation a MLC leaf pair.
+    A class describing a single scrollable canvas to edit the positions of all leaf pairs
+    of a LeafModel. Only the rows currently visible are drawn, so the number of canvas items
+    does not grow with the number of leaf pairs. Changes of the model are collected and
+    applied once per idle cycle by moving the existing canvas items. Drag a leaf to move it,
+    click a row to select it (Shift: range, Ctrl: toggle) and use the mouse wheel to scroll
+    or Ctrl + mouse wheel to zoom.
     """
-              
-    def __init__(self,root,row,values=[-5,5]):
-        
+
+    ROW_HEIGHT = 15
+    MIN_ROW_HEIGHT = 4
+    MAX_ROW_HEIGHT = 40
+    SELECT_COLOR = "#d9e6e6"
+
+    def __init__(self, root, model, width = 750, row_height = ROW_HEIGHT):
+
         self.root = root
-        self.row = (40+row*15)         
-        self.current_value = tk.DoubleVar()
-        self.mystring =tk.StringVar(root)
-        self.slider = Slider(self.root, width = 750, height = 19, min_val = -20, max_val = 20, init_lis = values, show_value = True)
-        self.slider.pack()
-        self.slider.place(y= self.row)
-        self.entry = tk.Entry(self.root, textvariable = self.mystring)
-        self.entry.pack()
-        self.entry.place(x=760,y=self.row)
-
-    def update_val(self):
-
-        """
-        A method to change the value of a LeafSlider.
-        """
-        
-        input = self.mystring.get()
-        negint = re.findall(r"-[0-9]+", input)
-        b = re.findall(r"[-+]?\d*\.\d+|\d+", input)
-        for num in negint:
-            for flt in b:
-                if float(num) == - float(flt):
-                    b.remove(flt)
-        b += negint
-        
-        if len(b)!= 2:
-            b = self.slider.getValues()
-            self.slider.destroy()
-            self.slider = Slider(self.root, width = 750, height = 19, min_val = -20, max_val = 20, init_lis = b, show_value = True)
-            self.slider.pack()
-            self.slider.place(y= self.row)
+        self.model = model if isinstance(model, LeafModel) else LeafModel(model)
+        self.W = width
+        self.row_height = row_height
+        self.selected = set()
+        self.anchor = None
+        self.drag = None
+        self.rows = {}                                                                                #Canvas items of every drawn row
+        self.dirty = set()                                                                            #Rows changed since the last update, None: all
+        self.pending = None
+
+        self.frame = tk.Frame(root)
+        self.canv = tk.Canvas(self.frame, width = width, highlightthickness = 0)
+        self.scrollbar = tk.Scrollbar(self.frame, orient = "vertical", command = self._yview)
+        self.canv.configure(yscrollcommand = self.scrollbar.set)
+        self.canv.pack(side = "left", fill = "y", expand = True)
+        self.scrollbar.pack(side = "left", fill = "y")
+
+        self.canv.bind("<Configure>", lambda event: self.scroll())
+        self.canv.bind("<Motion>", self._mouseMotion)
+        self.canv.bind("<ButtonPress-1>", self._press)
+        self.canv.bind("<B1-Motion>", self._moveBar)
+        self.canv.bind("<ButtonRelease-1>", self._release)
+        self.canv.bind("<MouseWheel>", self._wheel)                                                   #Windows and macOS
+        self.canv.bind("<Button-4>", self._wheel)                                                     #X11
+        self.canv.bind("<Button-5>", self._wheel)
+
+        self.model.subscribe(self._changed)
+        self._scrollregion()
+
+    def place(self, **kwargs):
+
+        self.frame.place(**kwargs)
+
+    def destroy(self):
+
+        self.frame.destroy()
+
+    def getValues(self):
+
+        return self.model.getValues()
+
+    def setValues(self, values):
+
+        self.model.setValues(values)
+
+    def setSelected(self, input):
+
+        """
+        A method that sets the selected leaf pairs to a typed pair of positions, e.g. "-5 5".
+        Returns False if nothing was selected or the text could not be read.
+        """
+
+        pair = parse_pair(input)
+
+        if pair is None or not self.selected:
+            return False
+
+        self.model.setRows(self.selected, pair)
+
+        return True
+
+    def zoom(self, factor):
+
+        """
+        A method that changes the row height by factor, keeping the top row in place.
+        """
+
+        top = self.canv.canvasy(0)/self.row_height
+        self.row_height = int(min(max(round(self.row_height*factor), self.MIN_ROW_HEIGHT), self.MAX_ROW_HEIGHT))
+        self._scrollregion()
+        self.canv.yview_moveto(top/max(len(self.model), 1))
+        self.redraw()
+
+    def visible_rows(self):
+
+        """
+        A method that returns the range of leaf pairs inside the visible part of the canvas.
+        """
+
+        top = self.canv.canvasy(0)
+        bottom = self.canv.canvasy(self.canv.winfo_height())
+
+        return range(max(int(top//self.row_height), 0), min(int(bottom//self.row_height) + 1, len(self.model)))
+
+    def redraw(self):
+
+        """
+        A method that draws the visible rows from scratch, e.g. after zooming.
+        """
+
+        self.canv.delete("row")
+        self.rows = {}
+        self.scroll()
+
+    def scroll(self):
+
+        """
+        A method that removes the rows scrolled out of view and draws the rows scrolled in.
+        """
+
+        visible = self.visible_rows()
+
+        for row in [row for row in self.rows if row not in visible]:
+            for item in self.rows.pop(row):
+                self.canv.delete(item)
+
+        for row in visible:
+            if row not in self.rows:
+                self.rows[row] = self._drawRow(row)
+
+    def _changed(self, rows):
+
+        """
+        A method called by the model, collecting the changed rows until Tk is idle.
+        """
+
+        if rows is None or self.dirty is None:
+            self.dirty = None
+        else:
+            self.dirty.update(rows)
+
+        if self.pending is None:
+            self.pending = self.canv.after_idle(self._update)
+
+    def _update(self):
+
+        """
+        A method that moves the canvas items of all changed rows at once.
+        """
+
+        self.pending = None
+        dirty, self.dirty = self.dirty, set()
+
+        if dirty is None and len(self.rows) and max(self.rows) >= len(self.model):                    #Fewer leaf pairs than before
+            self.selected = set()
+            self._scrollregion()
+            self.canv.yview_moveto(0)
+            self.redraw()
             return
 
-        c = [float(b[0]),float(b[1])]
-        self.slider.destroy()
-        self.slider = Slider(self.root, width = 750, height = 19, min_val = -20, max_val = 20, init_lis = c, show_value = True)
-        self.slider.pack()
-        self.slider.place(y= self.row)
-        return
\ No newline at end of file
+        if dirty is None:
+            self._scrollregion()
+
+        for row in (self.rows if dirty is None else dirty & set(self.rows)):
+            self._moveRow(row)
+
+        self.scroll()
+
+    def _drawRow(self, row):
+
+        """
+        A method that creates the canvas items of a row and returns their ids.
+        """
+
+        h = self.row_height
+        y = row*h + h/2
+        R = max(h/2 - 2, 1)
+
+        items = [self.canv.create_rectangle(0, row*h, self.W, (row+1)*h, outline = "", tags = "row", \
+            fill = self.SELECT_COLOR if row in self.selected else ""), \
+            self.canv.create_line(Slider.BAR_RADIUS, y, self.W - Slider.BAR_RADIUS, y, fill = Slider.LINE_COLOR, \
+            width = min(Slider.LINE_WIDTH, max(h//5, 1)), tags = "row")]
+
+        for value in self.model.values[row]:
+            x = self._x(value)
+            items += [self.canv.create_rectangle(x+2, y+R, x-2, y-R, fill = Slider.BAR_COLOR_OUTTER, outline = "", tags = "row")]
+
+        if h >= 12:                                                                                   #Values only where they are readable
+            for x_value, value in ((30, self.model.values[row][0]), (self.W - 30, self.model.values[row][1])):
+                id_value = self.canv.create_text(x_value, y, text = format(value, Slider.DIGIT_PRECISION), tags = "row")
+                id_box = self.canv.create_rectangle(x_value+13, y-6, x_value-13, y+6, fill = "white", tags = "row")
+                self.canv.tag_lower(id_box, id_value)
+                items += [id_value, id_box]
+
+        return items
+
+    def _moveRow(self, row):
+
+        """
+        A method that moves the leaves of a drawn row to the model values.
+        """
+
+        items = self.rows[row]
+        y = row*self.row_height + self.row_height/2
+        R = max(self.row_height/2 - 2, 1)
+
+        self.canv.itemconfig(items[0], fill = self.SELECT_COLOR if row in self.selected else "")
+
+        for item, value in zip(items[2:4], self.model.values[row]):
+            x = self._x(value)
+            self.canv.coords(item, x+2, y+R, x-2, y-R)
+
+        for item, value in zip(items[4::2], self.model.values[row]):
+            self.canv.itemconfig(item, text = format(value, Slider.DIGIT_PRECISION))
+
+    def _select(self, selected):
+
+        changed = self.selected ^ selected
+        self.selected = selected
+
+        for row in changed & set(self.rows):
+            self.canv.itemconfig(self.rows[row][0], fill = self.SELECT_COLOR if row in selected else "")
+
+    def _x(self, value):
+
+        return Slider.BAR_RADIUS + (value - self.model.min_val)/(self.model.max_val - self.model.min_val)*(self.W - 2*Slider.BAR_RADIUS)
+
+    def _value(self, x):
+
+        pos = min(max((x - Slider.BAR_RADIUS)/(self.W - 2*Slider.BAR_RADIUS), 0), 1)
+        return round(pos*(self.model.max_val - self.model.min_val) + self.model.min_val, 1)
+
+    def _scrollregion(self):
+
+        self.canv.configure(scrollregion = (0, 0, self.W, len(self.model)*self.row_height), \
+            yscrollincrement = self.row_height)
+
+    def _hit(self, event):
+
+        """
+        A method that returns the leaf pair and the leaf (0, 1 or None) under the mouse.
+        """
+
+        row = int(self.canv.canvasy(event.y)//self.row_height)
+
+        if not 0 <= row < len(self.model):
+            return None, None
+
+        distance = np.abs([self._x(value) - event.x for value in self.model.values[row]])
+        bank = int(np.argmin(distance))
+
+        return row, bank if distance[bank] <= Slider.BAR_RADIUS_INNER else None
+
+    def _mouseMotion(self, event):
+
+        self.canv.config(cursor = "hand2" if self._hit(event)[1] is not None else "")
+
+    def _press(self, event):
+
+        row, bank = self._hit(event)
+
+        if row is None:
+            return
+
+        if bank is not None:                                                                          #Grab a leaf
+            self.drag = (row, bank)
+            return
+
+        if event.state & 0x0001 and self.anchor is not None:                                          #Shift: select a range
+            self._select(set(range(min(self.anchor, row), max(self.anchor, row) + 1)))
+        elif event.state & 0x0004:                                                                    #Ctrl: toggle a row
+            self._select(self.selected ^ {row})
+            self.anchor = row
+        else:
+            self._select({row})
+            self.anchor = row
+
+    def _moveBar(self, event):
+
+        if self.drag is not None:
+            self.model.setLeaf(*self.drag, self._value(event.x))
+
+    def _release(self, event):
+
+        self.drag = None
+
+    def _wheel(self, event):
+
+        up = event.num == 4 or getattr(event, "delta", 0) > 0
+
+        if event.state & 0x0004:                                                                      #Ctrl: zoom
+            self.zoom(1.25 if up else 0.8)
+            return
+
+        self.canv.yview_scroll(-1 if up else 1, "units")
+        self.scroll()
+
+    def _yview(self, *args):
+
+        self.canv.yview(*args)
+        self.scroll()
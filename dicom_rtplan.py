@@ -0,0 +1,336 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming reader for the leaf positions and meterset weights of DICOM RT Plans.
+"""
+
+import struct
+import numpy as np
+
+
+###DICOM Tags used from RT Plans###
+
+TransferSyntaxUID                   = (0x0002, 0x0010)
+FractionGroupSequence               = (0x300A, 0x0070)
+BeamMeterset                        = (0x300A, 0x0086)
+BeamSequence                        = (0x300A, 0x00B0)
+BeamLimitingDeviceSequence          = (0x300A, 0x00B6)
+RTBeamLimitingDeviceType            = (0x300A, 0x00B8)
+NumberOfLeafJawPairs                = (0x300A, 0x00BC)
+LeafPositionBoundaries              = (0x300A, 0x00BE)
+BeamNumber                          = (0x300A, 0x00C0)
+BeamName                            = (0x300A, 0x00C2)
+FinalCumulativeMetersetWeight       = (0x300A, 0x010E)
+ControlPointSequence                = (0x300A, 0x0111)
+ControlPointIndex                   = (0x300A, 0x0112)
+BeamLimitingDevicePositionSequence  = (0x300A, 0x011A)
+LeafJawPositions                    = (0x300A, 0x011C)
+GantryAngle                         = (0x300A, 0x011E)
+CumulativeMetersetWeight            = (0x300A, 0x0134)
+ReferencedBeamSequence              = (0x300C, 0x0004)
+ReferencedBeamNumber                = (0x300C, 0x0006)
+
+Item                                = (0xFFFE, 0xE000)
+ItemDelimitationItem                = (0xFFFE, 0xE00D)
+SequenceDelimitationItem            = (0xFFFE, 0xE0DD)
+
+undefined_length = 0xFFFFFFFF
+long_vrs = {b"OB", b"OD", b"OF", b"OL", b"OV", b"OW", b"SQ", b"SV", b"UC", b"UN", b"UR", b"UT", b"UV"}
+
+implicit_little_endian = "1.2.840.10008.1.2"
+explicit_little_endian = "1.2.840.10008.1.2.1"
+
+class DicomReader:
+
+    """
+    A minimal streaming reader for little endian DICOM files. Elements are read one after
+    another from the file; values and sequences that are not asked for are skipped
+    without being read into memory.
+    """
+
+    def __init__(self, file):
+
+        self.file = file
+        self.explicit = True
+
+        preamble = file.read(132)
+
+        if preamble[128:132] != b"DICM":                                                              #No Part 10 header, assume a raw implicit VR dataset
+            file.seek(0)
+            self.explicit = False
+            return
+
+        syntax = None
+
+        while True:                                                                                   #File meta information, always explicit VR
+            position = file.tell()
+            header = self.header()
+
+            if header is None or header[0][0] != 0x0002:
+                file.seek(position)
+                break
+
+            if header[0] == TransferSyntaxUID:
+                syntax = self.text(header[2])
+            else:
+                self.skip(*header)
+
+        if syntax not in (None, implicit_little_endian, explicit_little_endian):
+            raise ValueError("Unsupported DICOM transfer syntax: " + str(syntax))
+
+        self.explicit = syntax != implicit_little_endian
+
+    def header(self):
+
+        """
+        A method that reads the next element header and returns (tag, VR, length),
+        or None at the end of the file.
+        """
+
+        data = self.file.read(8)
+
+        if len(data) < 8:
+            return None
+
+        group, element = struct.unpack("<HH", data[:4])
+        tag = (group, element)
+
+        if group == 0xFFFE or not self.explicit:                                                      #Items, delimiters and implicit VR elements
+            return tag, None, struct.unpack("<I", data[4:])[0]
+
+        vr = data[4:6]
+
+        if vr in long_vrs:
+            return tag, vr, struct.unpack("<I", self.file.read(4))[0]
+
+        return tag, vr, struct.unpack("<H", data[6:])[0]
+
+    def elements(self, length = undefined_length):
+
+        """
+        A method that yields (tag, VR, length) for the elements of a dataset of the given
+        length. Values that the caller neither reads nor iterates are skipped.
+        """
+
+        end = None if length == undefined_length else self.file.tell() + length
+
+        while end is None or self.file.tell() < end:
+            header = self.header()
+
+            if header is None or header[0] == ItemDelimitationItem:
+                return
+
+            start = self.file.tell()
+            yield header
+
+            if self.file.tell() == start:
+                self.skip(*header)
+
+    def items(self, length = undefined_length):
+
+        """
+        A method that yields the length of every item of a sequence, with the file
+        positioned at the first element of the item.
+        """
+
+        end = None if length == undefined_length else self.file.tell() + length
+
+        while end is None or self.file.tell() < end:
+            header = self.header()
+
+            if header is None or header[0] == SequenceDelimitationItem:
+                return
+
+            tag, _, item_length = header
+            start = self.file.tell()
+            yield item_length
+
+            if item_length != undefined_length:                                                       #Continue after the item, however much of it was read
+                self.file.seek(start + item_length)
+            elif self.file.tell() == start:
+                for _ in self.elements():
+                    pass
+
+    def skip(self, tag, vr, length):
+
+        """
+        A method that skips the value of an element, including nested sequences of
+        undefined length.
+        """
+
+        if length != undefined_length:
+            self.file.seek(length, 1)
+            return
+
+        for _ in self.items():                                                                        #Undefined length: a sequence, skipped item by item
+            pass
+
+    def text(self, length):
+
+        """
+        A method that reads a string value, e.g. CS, LO, UI or IS.
+        """
+
+        return self.file.read(length).decode("ascii", "replace").strip(" \0")
+
+    def numbers(self, length):
+
+        """
+        A method that reads a multi-valued IS/DS value as a float array.
+        """
+
+        value = self.text(length)
+        return np.array(value.split("\\"), dtype = float) if value else np.empty(0)
+
+def read_beam_meterset(reader, length):
+
+    """
+    A function that reads the beam MU of every referenced beam of a fraction group sequence.
+    """
+
+    meterset = {}
+
+    for group_length in reader.items(length):
+        for tag, vr, value_length in reader.elements(group_length):
+            if tag == ReferencedBeamSequence:
+                for beam_length in reader.items(value_length):
+                    number, mu = None, None
+
+                    for beam_tag, _, beam_value_length in reader.elements(beam_length):
+                        if beam_tag == ReferencedBeamNumber:
+                            number = int(reader.numbers(beam_value_length)[0])
+                        elif beam_tag == BeamMeterset:
+                            mu = reader.numbers(beam_value_length)[0]
+
+                    if number is not None and mu is not None:
+                        meterset[number] = float(mu)
+
+    return meterset
+
+def read_device_positions(reader, length):
+
+    """
+    A function that reads a beam limiting device position sequence into {device: positions}.
+    """
+
+    positions = {}
+
+    for item_length in reader.items(length):
+        device, values = None, None
+
+        for tag, vr, value_length in reader.elements(item_length):
+            if tag == RTBeamLimitingDeviceType:
+                device = reader.text(value_length)
+            elif tag == LeafJawPositions:
+                values = reader.numbers(value_length)
+
+        if device is not None and values is not None:
+            positions[device] = values
+
+    return positions
+
+def iter_control_points(path):
+
+    """
+    A generator that streams the control points of all beams of a DICOM RT Plan. Every
+    control point is a dictionary with the beam number, name and MU, the control point
+    index, the cumulative meterset weight, the gantry angle and the positions of the beam
+    limiting devices (e.g. "MLCX", "ASYMY") in mm. Values that a control point does not
+    repeat are carried over from the previous control point of the beam, as DICOM intends.
+    """
+
+    with open(path, "rb") as file:
+        reader = DicomReader(file)
+        meterset = {}
+
+        for tag, vr, length in reader.elements():
+            if tag == FractionGroupSequence:                                                          #Stored before the beam sequence
+                meterset.update(read_beam_meterset(reader, length))
+
+            elif tag == BeamSequence:
+                for beam_length in reader.items(length):
+                    beam = {"beam": None, "name": "", "mu": None, "final_cumulative_meterset_weight": None}
+
+                    for beam_tag, _, beam_value_length in reader.elements(beam_length):
+                        if beam_tag == BeamNumber:
+                            beam["beam"] = int(reader.numbers(beam_value_length)[0])
+                            beam["mu"] = meterset.get(beam["beam"])
+                        elif beam_tag == BeamName:
+                            beam["name"] = reader.text(beam_value_length)
+                        elif beam_tag == FinalCumulativeMetersetWeight:
+                            beam["final_cumulative_meterset_weight"] = float(reader.numbers(beam_value_length)[0])
+                        elif beam_tag == ControlPointSequence:
+                            state = {"cumulative_meterset_weight": None, "gantry_angle": None, "devices": {}}
+
+                            for index, point_length in enumerate(reader.items(beam_value_length)):
+                                state = dict(state, index = index, devices = dict(state["devices"]))
+
+                                for point_tag, _, point_value_length in reader.elements(point_length):
+                                    if point_tag == ControlPointIndex:
+                                        state["index"] = int(reader.numbers(point_value_length)[0])
+                                    elif point_tag == CumulativeMetersetWeight:
+                                        state["cumulative_meterset_weight"] = float(reader.numbers(point_value_length)[0])
+                                    elif point_tag == GantryAngle:
+                                        state["gantry_angle"] = float(reader.numbers(point_value_length)[0])
+                                    elif point_tag == BeamLimitingDevicePositionSequence:
+                                        state["devices"].update(read_device_positions(reader, point_value_length))
+
+                                yield dict(beam, **state)
+
+def iter_beams(path, device = "MLCX"):
+
+    """
+    A generator that yields the beams of a DICOM RT Plan one at a time. Every beam is a
+    dictionary with its number, name and MU, the leaf positions of the given device as an
+    array (N_controlpoints x N_pairs x 2) in mm, the cumulative meterset weights, the MU
+    delivered from every control point to the next one and the gantry angles.
+    """
+
+    beam, points = None, []
+
+    for point in iter_control_points(path):
+        if points and point["beam"] != beam:
+            yield _beam_arrays(points, device)
+            points = []
+
+        beam = point["beam"]
+        points += [point]
+
+    if points:
+        yield _beam_arrays(points, device)
+
+def _beam_arrays(points, device):
+
+    """
+    A function that combines the control points of one beam into arrays.
+    """
+
+    first = points[0]
+    positions = np.array([point["devices"].get(device, np.empty(0)) for point in points], dtype = float)
+    positions = np.stack([positions[:, :positions.shape[1]//2], positions[:, positions.shape[1]//2:]], axis = -1)  #First half: bank A, second half: bank B
+
+    cumulative = np.array([np.nan if point["cumulative_meterset_weight"] is None else point["cumulative_meterset_weight"] \
+        for point in points])
+    final = first["final_cumulative_meterset_weight"] or (cumulative[-1] if len(cumulative) else 1)
+    mu = np.diff(cumulative, append = cumulative[-1])*(first["mu"] if first["mu"] is not None else 1)/(final or 1)
+
+    return {"beam": first["beam"], "name": first["name"], "mu": first["mu"], "leaf_positions": positions, \
+        "cumulative_meterset_weight": cumulative, "segment_mu": mu, \
+        "gantry_angle": np.array([np.nan if point["gantry_angle"] is None else point["gantry_angle"] for point in points])}
+
+def load_rtplan(path, device = "MLCX"):
+
+    """
+    A function that returns the leaf positions (N_controlpoints x N_pairs x 2) of all beams
+    of a DICOM RT Plan and the MU of every control point. Beams are read one at a time.
+    """
+
+    positions, mu = [], []
+
+    for beam in iter_beams(path, device):
+        positions += [beam["leaf_positions"]]
+        mu += [beam["segment_mu"]]
+
+    if not positions:
+        return np.empty((0, 0, 2)), np.empty(0)
+
+    return np.concatenate(positions), np.concatenate(mu)
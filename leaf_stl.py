@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+"""
+Reading, measuring, placing and writing leaf .stl meshes.
+"""
+
+import os
+import json
+import hashlib
+import numpy as np
+
+
+###Binary STL Record Layout###
+
+stl_header_size = 84                                                                                  #80 byte header + uint32 triangle count
+
+stl_dtype = np.dtype([("normal", "<f4", (3,)), ("vertices", "<f4", (3, 3)), ("attribute", "<u2")])   #50 byte triangle record
+
+cache_dir = os.path.join(os.path.expanduser("~"), ".cache", "topas-custom-mlc")                       #Location of the measured leaf geometries
+
+_geometry_cache = {}
+
+def read_stl(path):
+
+    """
+    A function that reads a binary or ASCII .stl file and returns its triangles as a
+    float array of shape (N_triangles x 3 x 3). Binary files are memory-mapped, so only
+    the pages actually needed for the computation are read.
+    """
+
+    size = os.path.getsize(path)
+
+    with open(path, "rb") as file:
+        header = file.read(stl_header_size)
+
+    if len(header) == stl_header_size:
+        count = int(np.frombuffer(header, "<u4", 1, 80)[0])
+
+        if size == stl_header_size + count*stl_dtype.itemsize:                                        #Binary files can start with "solid" as well, so check the size
+            if count == 0:
+                return np.empty((0, 3, 3), dtype = np.float32)
+            return np.memmap(path, stl_dtype, "r", stl_header_size, (count,))["vertices"]
+
+    if header.lstrip().startswith(b"solid"):
+        return _read_ascii_stl(path)
+
+    raise ValueError("Not a valid .stl file: " + str(path))
+
+def _read_ascii_stl(path):
+
+    """
+    A function that parses the vertices of an ASCII .stl file.
+    """
+
+    with open(path, "rb") as file:
+        tokens = np.array(file.read().split())
+
+    vertex = np.flatnonzero(tokens == b"vertex")                                                      #Each vertex keyword is followed by its three coordinates
+    coordinates = tokens[vertex[:, np.newaxis] + np.arange(1, 4)].astype(float)
+
+    return coordinates.reshape(-1, 3, 3)
+
+def write_stl(path, triangles, header = b"topas-custom-mlc"):
+
+    """
+    A function that writes triangles (N_triangles x 3 x 3) as a binary .stl file,
+    computing the facet normals in one pass.
+    """
+
+    triangles = np.asarray(triangles, dtype = np.float32).reshape(-1, 3, 3)
+
+    normals = np.cross(triangles[:, 1] - triangles[:, 0], triangles[:, 2] - triangles[:, 0])
+    lengths = np.linalg.norm(normals, axis = 1, keepdims = True)
+    normals = np.divide(normals, lengths, out = np.zeros_like(normals), where = lengths > 0)
+
+    records = np.zeros(len(triangles), dtype = stl_dtype)
+    records["normal"] = normals
+    records["vertices"] = triangles
+
+    with open(path, "wb") as file:
+        file.write(header[:80].ljust(80, b" "))
+        file.write(np.array([len(records)], dtype = "<u4").tobytes())
+        file.write(records.tobytes())
+
+    return
+
+def place_leaves(triangles, TransX, TransY, TransZ, RotX):
+
+    """
+    A function that places copies of a leaf mesh (N_triangles x 3 x 3, in mm) like TOPAS
+    places the single-leaf TsCAD components and returns the merged mesh. TransX, TransY
+    and TransZ are given per leaf in mm, RotX in degrees. Geant4 placements rotate the
+    frame, so the points of each copy are rotated by -RotX before they are translated.
+    """
+
+    triangles = np.asarray(triangles, dtype = np.float32)
+
+    angle = -np.radians(np.asarray(RotX, dtype = float))
+    cos, sin = np.cos(angle), np.sin(angle)
+    ones, zeros = np.ones_like(angle), np.zeros_like(angle)
+
+    rotation = np.stack([np.stack([ones, zeros, zeros], -1), \
+        np.stack([zeros, cos, -sin], -1), np.stack([zeros, sin, cos], -1)], -2)                      #Rotation about X for every leaf (N_leaves x 3 x 3)
+    translation = np.stack(np.broadcast_arrays(TransX, TransY, TransZ), -1)                           #(N_leaves x 3)
+
+    placed = np.einsum("nij,tkj->ntki", rotation.astype(np.float32), triangles)
+    placed += translation.astype(np.float32)[:, np.newaxis, np.newaxis, :]
+
+    return placed.reshape(-1, 3, 3)
+
+def file_hash(path, chunk_size = 1 << 20):
+
+    """
+    A function that returns the SHA-256 hash of a file, read in chunks.
+    """
+
+    sha = hashlib.sha256()
+
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(chunk_size), b""):
+            sha.update(chunk)
+
+    return sha.hexdigest()
+
+def measure_leaf(triangles, tip_tolerance = 0.01):
+
+    """
+    A function that measures a single leaf mesh (N_triangles x 3 x 3, in mm). The leaf is
+    expected to move along X, be stacked along Y and face the beam along Z, as in the TOPAS
+    file. The tip face is made up of all triangles within tip_tolerance (relative to the
+    leaf length) of the leaf end closest to the Z-axis.
+    """
+
+    triangles = np.asarray(triangles, dtype = float)
+    vertices = triangles.reshape(-1, 3)
+    lower = vertices.min(axis = 0)
+    upper = vertices.max(axis = 0)
+
+    inner_edge = lower[0] if abs(lower[0]) <= abs(upper[0]) else upper[0]                             #Leaf end closest to the central axis
+
+    centroids = triangles.mean(axis = 1)
+    tip = np.abs(centroids[:, 0] - inner_edge) <= tip_tolerance*(upper[0] - lower[0])
+    tip_vertices = triangles[tip].reshape(-1, 3)
+
+    geometry = {
+        "bounding_box": [lower.tolist(), upper.tolist()],
+        "number_of_triangles": len(triangles),
+        "length": float(upper[0] - lower[0]),
+        "thickness": float(upper[1] - lower[1]),
+        "height": float(upper[2] - lower[2]),
+        "tip_face": [tip_vertices.min(axis = 0).tolist(), tip_vertices.max(axis = 0).tolist()] \
+            if len(tip_vertices) else None,
+        "dist_from_xy_plane_to_top_edge": float(upper[2]),                                            #Z-Coordinate of the top edge of the leaf
+        "dist_from_z_axis_to_inner_edge": float(inner_edge),                                          #X-Coordinate of the field defining face
+        "leaf_pitch": float(upper[1] - lower[1]),                                                     #Spacing between neighbouring leaves (TransY)
+    }
+
+    return geometry
+
+def leaf_geometry(path, use_cache = True):
+
+    """
+    A function that returns the measured geometry of a leaf .stl file, see measure_leaf().
+    Results are cached in memory and in cache_dir, keyed by the file hash, so the mesh
+    is only parsed once.
+    """
+
+    key = file_hash(path)
+
+    if use_cache and key in _geometry_cache:
+        return _geometry_cache[key]
+
+    cache_file = os.path.join(cache_dir, key + ".json")
+
+    if use_cache and os.path.isfile(cache_file):
+        with open(cache_file) as file:
+            geometry = json.load(file)
+
+    else:
+        geometry = measure_leaf(read_stl(path))
+
+        if use_cache:
+            try:
+                os.makedirs(cache_dir, exist_ok = True)
+                with open(cache_file, "w") as file:
+                    json.dump(geometry, file)
+            except OSError:                                                                           #Caching is optional, e.g. on read-only home directories
+                pass
+
+    _geometry_cache[key] = geometry
+
+    return geometry
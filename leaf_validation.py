@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+"""
+Vectorized checks of leaf sequences against mechanical limits.
+"""
+
+import numpy as np
+
+
+###Default Leaf Sequence Limits###
+
+default_limits = {
+    "max_position": 20,                                                                               #Maximum distance of a leaf from the central axis (cm)
+    "min_gap": 0,                                                                                     #Minimum gap between opposing leaves (cm)
+    "max_interdigitation": None,                                                                      #Maximum overlap of a leaf with the opposing neighbour leaves (cm), None: no limit
+    "max_travel": None,                                                                               #Maximum leaf travel between control points (cm), None: no limit
+    "max_speed": None,                                                                                #Maximum leaf speed (cm/s), needs the control point times, None: no limit
+    "dose_rate": None,                                                                                #Dose rate (MU/min) giving the control point times from the MU weights for max_speed
+}
+
+chunk_size = 4096                                                                                     #Control points validated at once, bounds the temporary arrays of long sequences
+
+violation_dtype = np.dtype([("controlpoint", "i8"), ("pair", "i4"), ("bank", "i1"), ("check", "U16"), ("value", "f8")])
+
+def validate_sequence(leaf_positions, limits = None, times = None, first_controlpoint = 0):
+
+    """
+    A function that checks a control point sequence (N_controlpoints x N_pairs x 2) against
+    the limits (see default_limits). Like the written files, the two positions of a pair
+    are unordered: the smaller one is taken as the left leaf, so opposing leaves never
+    cross and a pair can only be closer than min_gap. Returns a structured array (violation_dtype) with one entry per
+    violation; bank is 0/1 for single-leaf checks and -1 for checks of a leaf pair.
+    times holds the time of every control point in s and is needed for max_speed.
+    """
+
+    limits = dict(default_limits, **(limits or {}))
+    positions = np.asarray(leaf_positions, dtype = float).reshape(-1, *np.shape(leaf_positions)[-2:])
+    positions = np.sort(positions, axis = -1)                                                         #Assign each value to the correct leaf bank, see Projection.transx()
+    left, right = positions[..., 0], positions[..., 1]
+    gap = right - left
+
+    checks = [("min_gap", gap < limits["min_gap"], -1, gap), \
+        ("out_of_range", np.abs(positions) > limits["max_position"], None, positions)]
+
+    if limits["max_interdigitation"] is not None:                                                     #Overlap of a left leaf with the right leaves of the neighbour pairs
+        previous_pair = np.pad(left[:, 1:] - right[:, :-1], ((0, 0), (1, 0)), constant_values = -np.inf)
+        next_pair = np.pad(left[:, :-1] - right[:, 1:], ((0, 0), (0, 1)), constant_values = -np.inf)
+        overlap = np.maximum(previous_pair, next_pair)
+        checks += [("interdigitation", overlap > limits["max_interdigitation"], -1, overlap)]
+
+    if limits["max_travel"] is not None or limits["max_speed"] is not None:
+        travel = np.abs(np.diff(positions, axis = 0, prepend = positions[:1]))                        #Leaf travel since the previous control point
+
+        if limits["max_travel"] is not None:
+            checks += [("max_travel", travel > limits["max_travel"], None, travel)]
+
+        if limits["max_speed"] is not None:
+            if times is None:
+                raise ValueError("The control point times are needed to check the leaf speed")
+
+            duration = np.diff(np.asarray(times, dtype = float), prepend = times[0])[:, np.newaxis, np.newaxis]
+            with np.errstate(divide = "ignore", invalid = "ignore"):
+                speed = np.where(travel > 0, travel/duration, 0)
+            checks += [("max_speed", speed > limits["max_speed"], None, speed)]
+
+    violations = []
+
+    for name, mask, bank, values in checks:
+        index = np.nonzero(mask)
+        found = np.zeros(len(index[0]), dtype = violation_dtype)
+        found["controlpoint"] = index[0] + first_controlpoint
+        found["pair"] = index[1]
+        found["bank"] = index[2] if bank is None else bank
+        found["check"] = name
+        found["value"] = values[index]
+        violations += [found]
+
+    return np.concatenate(violations)
+
+def controlpoint_times(weights, dose_rate):
+
+    """
+    A function that returns the time (s) at which every control point is reached when the
+    MU weights of the preceding control points are delivered at the dose rate (MU/min).
+    """
+
+    return np.concatenate([[0], np.cumsum(weights, dtype = float)[:-1]])*60/dose_rate
+
+def validate_stream(chunks, limits = None, times = None):
+
+    """
+    A function that validates a control point sequence delivered in chunks, e.g. read
+    lazily from disk, and yields the violations of every chunk. Leaf travel and speed
+    are checked across chunk boundaries as well.
+    """
+
+    start = 0
+    previous = None
+
+    for chunk in chunks:
+        chunk = np.asarray(chunk, dtype = float).reshape(-1, *np.shape(chunk)[-2:])
+        first = start if previous is None else start-1
+
+        if previous is not None:                                                                      #Prepend the previous control point to check the travel
+            chunk = np.concatenate([previous[np.newaxis], chunk])
+
+        chunk_times = None if times is None else np.asarray(times, dtype = float)[first:first+len(chunk)]
+        violations = validate_sequence(chunk, limits, chunk_times, first)
+
+        yield violations[violations["controlpoint"] >= start]
+
+        previous = chunk[-1]
+        start = first + len(chunk)
+
+def summarize(violations):
+
+    """
+    A function that counts the violations per check and lists the affected control points.
+    """
+
+    summary = {"valid": len(violations) == 0, "violations": len(violations)}
+
+    for check in np.unique(violations["check"]):
+        found = violations[violations["check"] == check]
+        summary[str(check)] = {"count": len(found), "controlpoints": np.unique(found["controlpoint"]).tolist()}
+
+    return summary
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""
+Machine profiles describing non-uniform leaf layouts of real MLC models.
+"""
+
+import os
+import json
+import numpy as np
+
+
+profile_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "profiles")                   #Machine profiles shipped with the tool
+
+_compiled_profiles = {}
+
+def load_profile(profile):
+
+    """
+    A function that returns a machine profile as a dictionary. profile may be a dictionary,
+    the path of a .json file or the name of a file in profile_dir. A profile describes the
+    leaf layout of one MLC model:
+    - zones : list of [number of leaf pairs, pitch (mm)], from the first to the last pair
+    - focus_distance : distance from the focus (source) to the leaves in mm, tilts every
+      leaf towards the focus, optional
+    - tilt : additional tilt of every leaf in deg, one value or one per pair, optional
+    - TransZ : vertical position of every leaf in cm, one value or one per pair, optional
+    """
+
+    if isinstance(profile, dict):
+        return profile
+
+    path = profile
+
+    if not os.path.isfile(path):
+        path = os.path.join(profile_dir, profile if profile.endswith(".json") else profile + ".json")
+
+    with open(path) as file:
+        return json.load(file)
+
+def compile_profile(profile):
+
+    """
+    A function that compiles a machine profile (see load_profile()) into the leaf layout
+    arrays used by CreateTopasMLCFile(): TransY (mm), TransZ (cm), RotX (deg) and the
+    pitch of every leaf pair (mm). Profile files are compiled once per modification time.
+    """
+
+    if isinstance(profile, dict):
+        key = json.dumps(profile, sort_keys = True)
+    else:
+        path = profile if os.path.isfile(profile) else os.path.join(profile_dir, \
+            profile if profile.endswith(".json") else profile + ".json")
+        key = (os.path.abspath(path), os.stat(path).st_mtime_ns)
+
+    if key not in _compiled_profiles:
+        _compiled_profiles[key] = _compile(load_profile(profile))
+
+    return _compiled_profiles[key]
+
+def _compile(profile):
+
+    """
+    A function that computes the leaf layout arrays of a machine profile.
+    """
+
+    zones = np.asarray(profile["zones"], dtype = float).reshape(-1, 2)
+    pitch = np.repeat(zones[:, 1], zones[:, 0].astype(int))
+    number_of_leaf_pairs = len(pitch)
+
+    edges = np.concatenate([[0], np.cumsum(pitch)])
+    edges -= edges[-1]/2                                                                              #Centre the MLC on the axis
+    TransY = (edges[:-1] + edges[1:])/2
+
+    RotX = np.full(number_of_leaf_pairs, 180.)
+    RotX += np.broadcast_to(np.asarray(profile.get("tilt", 0), dtype = float), (number_of_leaf_pairs,))
+
+    if profile.get("focus_distance"):                                                                 #Leaf sides pointing towards the focus
+        RotX += np.degrees(np.arctan(TransY/profile["focus_distance"]))
+
+    TransZ = np.broadcast_to(np.asarray(profile.get("TransZ", 0), dtype = float), (number_of_leaf_pairs,)).copy()
+
+    layout = {"TransY": np.round(TransY, 6), "TransZ": np.round(TransZ, 6), "RotX": np.round(RotX, 6), "pitch": pitch}
+
+    for array in layout.values():
+        array.setflags(write = False)                                                                 #Shared between all callers
+
+    return layout
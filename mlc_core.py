@@ -0,0 +1,809 @@
+# -*- coding: utf-8 -*-
+"""
+GUI-free core of the tool: leaf position math and TOPAS MLC file writing.
+"""
+
+import os
+import sys
+import json
+import argparse
+import numpy as np
+from functools import partial
+from leaf_stl import leaf_geometry, read_stl, write_stl, place_leaves
+from leaf_validation import validate_stream, summarize, controlpoint_times, chunk_size
+from sequence_reduction import merge_similar, resample
+from dicom_rtplan import load_rtplan
+from machine_profiles import compile_profile
+import profiling
+from profiling import stage
+
+
+###TOPAS Simulation File Format with Blanks###
+
+materials = '\
+#==========================MATERIALS==========================#\n\n\
+sv:Ma/LeafMaterial/Components   = 3 "Tungsten" "Nickel" "Iron"\n\
+uv:Ma/LeafMaterial/Fractions 	= 3 0.95 00.0375 0.0125\n\
+d:Ma/LeafMaterial/Density       = 18 g/cm3\n\n'
+
+mlcgroup = '\
+#=================MLC GROUP===============#\n\n\
+s:Ge/MLCGroup/Type              = "Group"\n\
+s:Ge/MLCGroup/Parent        	= "World"\n\
+d:Ge/MLCGroup/TransZ            = {} cm\n\n' 
+
+placement_left = '\
+#===============PLACEMENT GROUP=============#\n\n\
+s:Ge/LeftGroup/Type 	    	= "Group"\n\
+s:Ge/LeftGroup/Parent       	= "MLCGroup"\n\
+d:Ge/LeftGroup/RotX             = 180 deg\n\
+d:Ge/LeftGroup/TransZ	    	= {} mm\n\n' 
+
+placement_right = '\
+s:Ge/RightGroup/Type        	= "Group"\n\
+s:Ge/RightGroup/Parent 	    	= "MLCGroup"\n\
+d:Ge/RightGroup/RotY 	    	= 180 deg\n\
+d:Ge/RightGroup/TransZ	    	= {} mm\n\n\
+#===================COMPONENTS===============#\n\n' 
+
+left_leaf_parameters    = '\
+s:Ge/LeftLeaf{i}/Type             = "TsCAD"\n\
+s:Ge/LeftLeaf{i}/Parent           = "LeftGroup"\n\
+s:Ge/LeftLeaf{i}/Material         = "LeafMaterial"\n\
+d:Ge/LeftLeaf{i}/TransX           = {TransX} mm\n\
+d:Ge/LeftLeaf{i}/TransY           = {TransY} mm\n\
+d:Ge/LeftLeaf{i}/TransZ           = {TransZ} cm\n\
+d:Ge/LeftLeaf{i}/RotX             = {RotX} deg\n\
+s:Ge/LeftLeaf{i}/DrawingStyle     = "Solid"\n\
+s:Ge/LeftLeaf{i}/InputFile        = "{InputFile}"\n\
+s:Ge/LeftLeaf{i}/FileFormat       = "stl" \n\
+d:Ge/LeftLeaf{i}/Units            = 1 mm\n\
+s:Ge/LeftLeaf{i}/Color            = {Color}\n\n'
+
+right_leaf_parameters   = '\
+s:Ge/RightLeaf{i}/Type            = "TsCAD"\n\
+s:Ge/RightLeaf{i}/Parent          = "RightGroup"\n\
+s:Ge/RightLeaf{i}/Material        = "LeafMaterial"\n\
+d:Ge/RightLeaf{i}/TransX          = {TransX} mm\n\
+d:Ge/RightLeaf{i}/TransY          = {TransY} mm\n\
+d:Ge/RightLeaf{i}/TransZ          = {TransZ} cm\n\
+d:Ge/RightLeaf{i}/RotX            = {RotX} deg\n\
+s:Ge/RightLeaf{i}/DrawingStyle    = "Solid"\n\
+s:Ge/RightLeaf{i}/InputFile       = "{InputFile}"\n\
+s:Ge/RightLeaf{i}/FileFormat      = "stl"\n\
+d:Ge/RightLeaf{i}/Units           = 1 mm\n\
+s:Ge/RightLeaf{i}/Color           = {Color}\n\n'
+
+left_bank_parameters    = '\
+s:Ge/LeftBank/Type               = "TsCAD"\n\
+s:Ge/LeftBank/Parent             = "LeftGroup"\n\
+s:Ge/LeftBank/Material           = "LeafMaterial"\n\
+s:Ge/LeftBank/DrawingStyle       = "Solid"\n\
+s:Ge/LeftBank/InputFile          = "{InputFile}"\n\
+s:Ge/LeftBank/FileFormat         = "stl"\n\
+d:Ge/LeftBank/Units              = 1 mm\n\
+s:Ge/LeftBank/Color              = "Grey080"\n\n'
+
+right_bank_parameters   = '\
+s:Ge/RightBank/Type              = "TsCAD"\n\
+s:Ge/RightBank/Parent            = "RightGroup"\n\
+s:Ge/RightBank/Material          = "LeafMaterial"\n\
+s:Ge/RightBank/DrawingStyle      = "Solid"\n\
+s:Ge/RightBank/InputFile         = "{InputFile}"\n\
+s:Ge/RightBank/FileFormat        = "stl"\n\
+d:Ge/RightBank/Units             = 1 mm\n\
+s:Ge/RightBank/Color             = "Grey160"\n\n'
+
+timeline = '\
+#================TIME FEATURES===============#\n\n\
+i:Tf/NumberOfSequentialTimes    = {}\n\
+d:Tf/TimelineEnd                = {} ms\n\n'
+
+leaf_time_feature = '\
+s:Tf/{leaf}TransX/Function  = "Step"\n\
+dv:Tf/{leaf}TransX/Times    = {count} {times} ms\n\
+dv:Tf/{leaf}TransX/Values   = {count} {values} mm\n\n'
+
+include_file = '\
+includeFile = {}\n\n'
+
+left_leaf_override  = 'd:Ge/LeftLeaf{}/{:<17}= {} {}\n'
+right_leaf_override = 'd:Ge/RightLeaf{}/{:<16}= {} {}\n'
+
+override_units = {"TransX": "mm", "TransY": "mm", "TransZ": "cm", "RotX": "deg"}
+
+load_scale = 2                                                                                        #Scale of the projection for leaf positions loaded from files (load_mlc_data(), command line tools); the GUI uses 1
+
+def machine_setup():
+
+    """
+    A function that returns the MLC configuration used by load_mlc_data() and the command
+    line tools as a dictionary. Offsets and the leaf pitch left as None are measured from
+    the leaf .stl file, see calibrate_from_stl().
+    """
+
+    ###################SETUP###################
+
+    leaf_stl_path = ""                                                                                #Path to single leaf .stl file
+    number_of_leaf_pairs = 80                                                                         #Amount of leaf pairs in MLC configuration
+    MLC_TransZ = 0 #cm                                                                                #Translation distance of whole MLC along Z
+    SSD = 100 #cm                                                                                     #Source-Surface-Distance
+    dist_from_xy_plane_to_top_edge = None #mm                                                         #Correction amount from stl coordinates to TOPAS (z-axis), None: measure from .stl
+    dist_from_z_axis_to_inner_edge = None #mm                                                         #Correction amount from stl coordinates to TOPAS (x/y-axis), None: measure from .stl
+    leaf_pitch = None #mm                                                                             #Spacing between neighbouring leaves (TransY), None: measure from .stl
+    leaf_end = None                                                                                   #Rounded leaf end calibration, (position, offset) table in cm or .txt file, see Projection
+    pair_offset = None                                                                                #Leaf tip calibration per leaf pair, (pair, offset) table in cm or .txt file, see Projection
+    profile = None                                                                                    #Machine profile with non-uniform leaf layout (name or .json file), see machine_profiles.py
+   
+    ###########################################
+
+    dist_from_xy_plane_to_top_edge, dist_from_z_axis_to_inner_edge, leaf_pitch = calibrate_from_stl( \
+        leaf_stl_path, dist_from_xy_plane_to_top_edge, dist_from_z_axis_to_inner_edge, leaf_pitch)
+
+    return {"leaf_stl_path": leaf_stl_path, "number_of_leaf_pairs": number_of_leaf_pairs, \
+        "MLC_TransZ": MLC_TransZ, "SSD": SSD, "dist_from_xy_plane_to_top_edge": dist_from_xy_plane_to_top_edge, \
+        "dist_from_z_axis_to_inner_edge": dist_from_z_axis_to_inner_edge, "leaf_pitch": leaf_pitch, \
+        "leaf_end": leaf_end, "pair_offset": pair_offset, "profile": profile}
+
+def load_mlc_data(input, output = "DICOM_MLC_POS.txt", workers = 1, mode = "static", limits = None, \
+    tolerance = None, segments = None, setup = None, cache = None, weights = None, times = None):
+
+    """
+    A function that loads specified MLC leaf positions from a numpy .txt/.npy/.npz file,
+    a DICOM RT Plan (.dcm) or a directory of such files and creates the according simulation files. Every
+    control point gets its own file; for sequences the output name is templated with
+    the control point index, e.g. DICOM_MLC_POS_0000.txt. With workers > 1 the files
+    are written by a process pool. With mode = "dynamic" the whole sequence is written
+    to a single file using TOPAS time features, with mode = "include" the geometry is written
+    once and every control point file only overrides TransX, with mode = "merged" every
+    control point gets two pre-positioned bank meshes. Returns the list of written files.
+
+    If limits are given (see leaf_validation.default_limits), the sequence is validated in
+    chunks before any file is written and a ValueError is raised for invalid sequences. The
+    leaf speed is checked at the control point times given by times, or by the weights
+    delivered at the dose rate of the limits.
+
+    With a tolerance (cm), consecutive control points within the tolerance are merged, with
+    segments the sequence is resampled to that number of segments. weights holds the MU
+    (meterset weight) of every control point and defaults to the MU of an RT Plan, or to 1.
+    The index of the written segment for every original control point is saved to
+    <output>_mapping.txt. The (summed) weight of every written file is saved to
+    <output>_weights.txt if the weights are known or the sequence was reduced.
+
+    times holds the end time (ms) of every control point step; without weights, the step
+    durations are used as weights. In dynamic mode, the step end times are derived from the
+    cumulative weights, spread over the total time (10 ms per written control point by default).
+
+    setup defaults to machine_setup(). cache is the directory of the output cache, see
+    write_mlc_files(). Instead of a path, input may also be an array of leaf positions.
+    """
+
+    if not isinstance(input, np.ndarray) and os.path.exists(input) != True:
+        return
+
+    setup = machine_setup() if setup is None else setup
+    
+    with stage("load"):
+        if isinstance(input, np.ndarray):                                                             #Leaf positions passed directly, e.g. by the service
+            leaf_positions = input.astype(float).reshape(-1, setup["number_of_leaf_pairs"], 2)
+        else:
+            leaf_positions, plan_weights = load_control_points(input, setup["number_of_leaf_pairs"], \
+                return_weights = True)                                                                #Load all control points as (N_controlpoints x N_pairs x 2)
+            weights = plan_weights if weights is None else weights
+
+    if leaf_positions.shape[1] != setup["number_of_leaf_pairs"]:                                      #E.g. an RT Plan of a different MLC model
+        raise ValueError("Expected {} leaf pairs, found {}".format(setup["number_of_leaf_pairs"], leaf_positions.shape[1]))
+
+    if weights is not None and len(weights) != len(leaf_positions):
+        raise ValueError("Expected {} weights, found {}".format(len(leaf_positions), len(weights)))
+
+    if times is not None:
+        times = np.asarray(times, dtype = float)
+        if len(times) != len(leaf_positions):
+            raise ValueError("Expected {} times, found {}".format(len(leaf_positions), len(times)))
+        if weights is None:                                                                           #Constant dose rate: the MU follow the step durations
+            weights = np.diff(times, prepend = 0)
+
+    duration = None if times is None else times[-1]                                                   #Total time of the sequence in ms
+
+    if limits is not None:                                                                            #Reject invalid leaf sequences up front
+        controlpoints = None
+
+        if times is not None:                                                                         #Every control point is reached at the end of the previous step
+            controlpoints = np.concatenate([[0], times[:-1]])/1000
+        elif weights is not None and limits.get("dose_rate") is not None:
+            controlpoints = controlpoint_times(weights, limits["dose_rate"])
+
+        with stage("validate"):
+            chunks = (leaf_positions[i:i+chunk_size] for i in range(0, len(leaf_positions), chunk_size))
+            summary = summarize(np.concatenate(list(validate_stream(chunks, limits, controlpoints))))
+        if not summary["valid"]:
+            raise ValueError("Invalid leaf sequence: " + str(summary))
+
+    stem = os.path.splitext(output)[0].split("{")[0].rstrip("_")
+
+    if tolerance is not None or segments is not None:                                                 #Reduce the number of geometries to simulate
+        with stage("reduce"):
+            mapping = np.arange(len(leaf_positions))
+
+            if tolerance is not None:
+                leaf_positions, weights, merged = merge_similar(leaf_positions, weights, tolerance = tolerance)
+                mapping = merged[mapping]
+
+            if segments is not None:
+                leaf_positions, weights, resampled = resample(leaf_positions, segments, weights)
+                mapping = resampled[mapping]
+
+            times = None                                                                              #The segment times follow from the summed weights
+
+        np.savetxt(stem + "_mapping.txt", np.column_stack([np.arange(len(mapping)), mapping]), fmt = "%d")
+
+    if weights is not None:
+        np.savetxt(stem + "_weights.txt", weights)                                                    #MU of every written file
+
+    if mode == "dynamic" and times is None and weights is not None:                                   #Leaves dwell in proportion to the MU of a control point
+        times = step_times(weights, 10*len(leaf_positions) if duration is None else duration)
+
+    with stage("transx"):
+        TransX = Projection.from_setup(setup).transx(leaf_positions)
+
+    return write_mlc_files(TransX, output, setup, mode, workers, cache, times)
+
+def write_mlc_files(TransX, output, setup, mode = "static", workers = 1, cache = None, times = None):
+
+    """
+    A function that writes the simulation files for a TransX sequence (N_controlpoints x 2 x N_pairs)
+    using the configuration setup (see machine_setup()) and returns the written files. See
+    load_mlc_data() for the output modes and names. With a cache directory, static and
+    dynamic files are taken from the output cache if the identical geometry was already
+    created, see output_cache.py. times are the step end times (ms) of the dynamic mode.
+    """
+
+    writer = CreateTopasMLCFile
+
+    if cache is not None and mode in ("static", "dynamic"):
+        from output_cache import CreateCachedTopasMLCFile                                             #Imported here, the cache builds on this module
+        writer = partial(CreateCachedTopasMLCFile, cache_dir = cache)
+
+    geometry = (setup["leaf_stl_path"], setup["number_of_leaf_pairs"], \
+        setup["dist_from_xy_plane_to_top_edge"], setup["MLC_TransZ"])
+
+    if mode == "dynamic":                                                                             #One file moving the leaves through all control points
+        writer(output, *geometry, TransX, mode = mode, times = times, leaf_pitch = setup["leaf_pitch"], \
+            profile = setup.get("profile"))
+        return [output]
+
+    if mode == "include":                                                                             #Shared base file plus one small file per control point
+        return CreateTopasMLCFile(output, *geometry, TransX, mode = mode, leaf_pitch = setup["leaf_pitch"], \
+            profile = setup.get("profile"))
+
+    filenames = output_filenames(output, len(TransX))
+
+    if workers > 1 and len(TransX) > 1:                                                               #Fan the rendering out over a process pool
+        from concurrent.futures import ProcessPoolExecutor                                            #Imported here, it is the slowest import of a single-process run
+        with stage("pool"), ProcessPoolExecutor(max_workers = workers) as executor:                   #Stages inside the workers are not profiled
+            jobs = [executor.submit(writer, filename, *geometry, transx.tolist(), mode = mode, \
+                leaf_pitch = setup["leaf_pitch"], profile = setup.get("profile")) for filename, transx in zip(filenames, TransX)]
+            [job.result() for job in jobs]
+
+    else:
+        for filename, transx in zip(filenames, TransX):
+            writer(filename, *geometry, transx.tolist(), mode = mode, \
+                leaf_pitch = setup["leaf_pitch"], profile = setup.get("profile"))                     #Write TOPAS simulation file 
+
+    return filenames
+
+def load_control_points(input, number_of_leaf_pairs, return_weights = False):
+
+    """
+    A function that loads a sequence of control points from a stacked .txt file,
+    a .npy/.npz file, a DICOM RT Plan (.dcm) or a directory of such files. Returns an
+    array of shape (N_controlpoints x N_pairs x 2). Files that do not contain a multiple of
+    number_of_leaf_pairs rows are treated as a single control point. RT Plans provide the
+    MLCX positions of all control points of all beams, with their own number of pairs,
+    converted from mm to the cm used by all other inputs.
+
+    With return_weights, the MU of every control point is returned as well: the meterset
+    weights of RT Plans, or None if no RT Plan was loaded. Control points of other files in
+    a directory with RT Plans get a weight of 1.
+    """
+
+    if os.path.isdir(input):                                                                          #Directory: one or more control points per file, sorted by name
+        files = sorted(os.path.join(input, f) for f in os.listdir(input) \
+            if os.path.splitext(f)[1].lower() in (".txt", ".npy", ".npz", ".dcm"))
+        loaded = [load_control_points(f, number_of_leaf_pairs, True) for f in files]
+        leaf_positions = np.concatenate([positions for positions, _ in loaded])
+
+        if not return_weights:
+            return leaf_positions
+
+        if all(weights is None for _, weights in loaded):
+            return leaf_positions, None
+
+        return leaf_positions, np.concatenate([np.ones(len(positions)) if weights is None else weights \
+            for positions, weights in loaded])
+
+    extension = os.path.splitext(input)[1].lower()
+
+    if extension == ".dcm":                                                                           #Streamed beam by beam, see dicom_rtplan.py
+        leaf_positions, mu = load_rtplan(input)
+        leaf_positions = leaf_positions/10                                                            #RT Plans store the positions in mm
+        return (leaf_positions, mu) if return_weights else leaf_positions
+
+    if extension == ".npy":
+        arrays = [np.load(input)]
+
+    elif extension == ".npz":
+        with np.load(input) as archive:                                                               #Arrays are used in the order they were stored
+            arrays = [archive[key] for key in archive.files]
+
+    else:
+        arrays = [np.loadtxt(input, ndmin = 2)]
+
+    control_points = []
+
+    for array in arrays:
+        array = np.asarray(array, dtype = float)
+
+        if array.size % (2*number_of_leaf_pairs) == 0:                                                #Stacked control points
+            control_points += [array.reshape(-1, number_of_leaf_pairs, 2)]
+        else:
+            control_points += [array.reshape(1, -1, 2)]
+
+    leaf_positions = np.concatenate(control_points)
+
+    return (leaf_positions, None) if return_weights else leaf_positions
+
+def output_filenames(output, number_of_control_points):
+
+    """
+    A function that expands an output name into one filename per control point.
+    Names may contain an {index} field, e.g. "MLC_{index:03d}.txt"; otherwise the
+    index is appended to the stem for sequences of more than one control point.
+    """
+
+    if "{" not in output:
+        if number_of_control_points == 1:
+            return [output]
+
+        stem, extension = os.path.splitext(output)
+        output = stem + "_{index:04d}" + extension
+
+    return [output.format(index = i) for i in range(number_of_control_points)]
+
+def calibrate_from_stl(leaf_stl_path, dist_from_xy_plane_to_top_edge = None, \
+    dist_from_z_axis_to_inner_edge = None, leaf_pitch = None):
+
+    """
+    A function that fills in the stl offsets and the leaf pitch left as None in the
+    SETUP blocks by measuring the leaf .stl file (see leaf_stl.leaf_geometry()). Without
+    a readable .stl file, the defaults of 0 mm offset and 2 mm pitch are used.
+    """
+
+    values = {"dist_from_xy_plane_to_top_edge": dist_from_xy_plane_to_top_edge, \
+        "dist_from_z_axis_to_inner_edge": dist_from_z_axis_to_inner_edge, "leaf_pitch": leaf_pitch}
+    defaults = {"dist_from_xy_plane_to_top_edge": 0, "dist_from_z_axis_to_inner_edge": 0, "leaf_pitch": 2}
+
+    if None in values.values():
+        with stage("stl"):
+            geometry = leaf_geometry(leaf_stl_path) if os.path.isfile(leaf_stl_path) else defaults
+
+        for key, value in values.items():
+            if value is None:
+                values[key] = round(geometry[key], 3)
+
+    return values["dist_from_xy_plane_to_top_edge"], values["dist_from_z_axis_to_inner_edge"], values["leaf_pitch"]
+
+def field_size_calc(field_size, SSD, TransZ):
+
+    """
+    A function that calculates the desired field size using the intercept theorem.
+    """
+
+    return (TransZ/SSD) *field_size
+
+def calculate_transx(leaf_positions, SSD, MLC_TransZ, dist_from_z_axis_to_inner_edge, scale=1):
+
+    """
+    A function that converts leaf pair positions into the TransX values of both leaf banks
+    in one vectorized pass. Accepts an array of shape (..., N_pairs, 2), e.g. a single
+    (N_pairs x 2) matrix or a whole (N_controlpoints x N_pairs x 2) sequence, and returns
+    an array of shape (..., 2, N_pairs) holding the left bank and the reversed right bank,
+    in the order expected by CreateTopasMLCFile(). See Projection for calibrated leaf designs.
+    """
+
+    return Projection(SSD, MLC_TransZ, dist_from_z_axis_to_inner_edge, scale).transx(leaf_positions)
+
+class Projection:
+
+    """
+    Projection between leaf pair positions in the plane of the field (..., N_pairs x 2) and
+    the TransX values of both leaf banks (..., 2 x N_pairs), precomputed once per machine
+    configuration and applied to whole control point sequences at once.
+
+    Real leaves do not block the field exactly at their projected tip. Two calibration
+    tables, each given as (M x 2) array or two-column .txt file in cm in the plane of the
+    field, shift the field edge of every leaf away from the centre axis (positive: more
+    open, applied symmetrically to both banks):
+    - leaf_end : offset over the nominal edge position, for rounded leaf ends
+    - pair_offset : offset over the leaf pair index, for tips of individual leaf pairs
+      deviating from their nominal position, e.g. measured per pair
+    Both are looked up with np.interp, constant beyond the ends of the table. Offsets
+    must change slower than the positions they are looked up by, so the tables can be
+    inverted.
+    """
+
+    def __init__(self, SSD, MLC_TransZ, dist_from_z_axis_to_inner_edge = 0, scale = 1, \
+        leaf_end = None, pair_offset = None):
+
+        self.unit = field_size_calc(1, SSD, MLC_TransZ)                                              #Intercept theorem, evaluated once
+        self.scale = scale
+        self.dist_from_z_axis_to_inner_edge = dist_from_z_axis_to_inner_edge
+        self.leaf_end = self._table(leaf_end)
+        self.pair_offset = self._table(pair_offset)
+        self._pair_offsets = {}
+
+    @classmethod
+    def from_setup(cls, setup, scale = load_scale):
+
+        """
+        A method that creates the projection of a machine_setup() configuration, by default
+        with the scale used for leaf positions loaded from files (see load_scale).
+        """
+
+        return cls(setup["SSD"], setup["MLC_TransZ"], setup["dist_from_z_axis_to_inner_edge"], scale, \
+            setup.get("leaf_end"), setup.get("pair_offset"))
+
+    @staticmethod
+    def _table(table):
+
+        """
+        A method that returns a calibration table as (positions, offsets), sorted by position.
+        """
+
+        if table is None:
+            return None
+
+        table = np.loadtxt(table, ndmin = 2) if isinstance(table, str) else np.asarray(table, dtype = float)
+        table = table[np.argsort(table[:, 0])]
+
+        return table[:, 0], table[:, 1]
+
+    def pair_offsets(self, number_of_leaf_pairs):
+
+        """
+        A method that returns the tip offset of every leaf pair, cached per
+        number of leaf pairs.
+        """
+
+        if number_of_leaf_pairs not in self._pair_offsets:
+            self._pair_offsets[number_of_leaf_pairs] = np.zeros(number_of_leaf_pairs) if self.pair_offset is None \
+                else np.interp(np.arange(number_of_leaf_pairs), *self.pair_offset)
+
+        return self._pair_offsets[number_of_leaf_pairs]
+
+    def transx(self, leaf_positions):
+
+        """
+        A method that converts leaf pair positions (..., N_pairs x 2) into the TransX values
+        (..., 2 x N_pairs) of the left bank and the reversed right bank, in the order expected
+        by CreateTopasMLCFile().
+        """
+
+        positions = np.sort(np.asarray(leaf_positions, dtype=float), axis=-1)                        #Assign each value to the correct leaf bank
+
+        if self.leaf_end is not None or self.pair_offset is not None:
+            edges = positions*[-1, 1]                                                                 #Distance of both leaf edges from the axis, positive: open
+            if self.leaf_end is not None:
+                edges = edges + np.interp(edges, *self.leaf_end)
+            positions = (edges + self.pair_offsets(positions.shape[-2])[:, np.newaxis])*[-1, 1]
+
+        projected = self.scale*(self.unit*positions)                                                  #Field size calculation for all leaves at once
+
+        left  = np.round(projected[..., 0] - self.dist_from_z_axis_to_inner_edge, 3)                  #Account for the differences between the two coordinate systems
+        right = np.round(-projected[..., 1] - self.dist_from_z_axis_to_inner_edge, 3)
+
+        return np.stack([left, right[..., ::-1]], axis=-2)                                            #Account for the 180° rotation of the leaf bank placement
+
+    def positions(self, TransX):
+
+        """
+        A method that projects TransX values (..., 2 x N_pairs) back to the leaf pair
+        positions (..., N_pairs x 2) in the plane of the field, inverting transx().
+        """
+
+        if self.scale*self.unit == 0:
+            raise ValueError("MLC_TransZ must not be 0 to project the leaves to the field plane")
+
+        TransX = np.asarray(TransX, dtype = float)
+        left  = (TransX[..., 0, :] + self.dist_from_z_axis_to_inner_edge)/(self.scale*self.unit)
+        right = -(TransX[..., 1, ::-1] + self.dist_from_z_axis_to_inner_edge)/(self.scale*self.unit)   #Undo the reversed order of the right leaf bank
+        positions = np.stack([left, right], axis = -1)
+
+        if self.leaf_end is not None or self.pair_offset is not None:
+            edges = positions*[-1, 1] - self.pair_offsets(positions.shape[-2])[:, np.newaxis]
+            if self.leaf_end is not None:                                                             #The table is piecewise linear, so its inverse is as well
+                edges = edges - np.interp(edges, self.leaf_end[0] + self.leaf_end[1], self.leaf_end[1])
+            positions = edges*[-1, 1]
+
+        return positions
+
+def CreateTopasMLCFile(filename: str, leaf_stl_path: str, number_of_leaf_pairs: int, \
+    dist_from_xy_plane_to_top_edge: int, MLC_TransZ: int, TransX: list, \
+    materials = materials, mlcgroup = mlcgroup, placement_left = placement_left, \
+    placement_right = placement_right, mode = "static", times = None, overrides = None, \
+    leaf_pitch = 2, profile = None): 
+
+    """
+    A function that uses the specified parameters to create a TOPAS-readable simulation file
+    for a MLC. Needs a .stl (3D) file describing one leaf and the desired positioning info
+    to the place many of these in the correct positions. leaf_pitch is the spacing between
+    neighbouring leaves in mm, see calibrate_from_stl(). A machine profile replaces the
+    uniform leaf layout by the one of a real MLC model, see leaf_layout().
+
+    With mode = "dynamic", TransX is a whole control point sequence (N_controlpoints x 2 x N_pairs)
+    and each leaf TransX is driven by a TOPAS "Step" time feature, so the leaves are built once
+    and moved during the run. times holds the end time of each control point in ms and defaults
+    to 10 ms per control point.
+
+    With mode = "include", TransX is also a sequence. The complete geometry is written once to
+    filename and every control point gets a small file (filename_0000.txt, ...) that includes
+    it and only overrides the leaf TransX values. overrides may map "TransY", "TransZ" and
+    "RotX" to further (N_controlpoints x 2 x N_pairs) arrays to override per control point.
+    Returns the list of control point files.
+
+    With mode = "merged", the leaf .stl is placed for every leaf of a bank and written as one
+    pre-positioned mesh per bank (filename_left.stl, filename_right.stl), so the simulation
+    file only declares two TsCAD components.
+
+    In the other modes, overrides may map "TransY", "TransZ" and "RotX" to (2 x N_pairs) arrays,
+    ordered like TransX, that replace the leaf layout of each bank, e.g. for tilted leaf banks.
+    """
+
+    if mode == "include":
+        return CreateTopasMLCIncludeFiles(filename, leaf_stl_path, number_of_leaf_pairs, \
+            dist_from_xy_plane_to_top_edge, MLC_TransZ, TransX, overrides, materials, mlcgroup, \
+            placement_left, placement_right, leaf_pitch, profile)
+
+    with stage("render"):
+        TransY, TransZ, RotX = leaf_layout(number_of_leaf_pairs, leaf_pitch, profile)
+        TransYR = TransY                                                                              #Identical for both leaf banks
+        TransZR = TransZ                                                                              #Identical for both leaf banks
+        RotXR = RotX                                                                                  #Identical for both leaf banks
+
+        if overrides is not None:                                                                     #Separate layout for each leaf bank
+            layout = {"TransY": [TransY, TransYR], "TransZ": [TransZ, TransZR], "RotX": [RotX, RotXR]}
+            layout.update({key: np.asarray(value, dtype = float).tolist() for key, value in overrides.items()})
+            (TransY, TransYR), (TransZ, TransZR), (RotX, RotXR) = layout["TransY"], layout["TransZ"], layout["RotX"]
+
+        leftcolors  = ['"Grey080"','"Grey160"']*int(number_of_leaf_pairs/2)                           #Alternating color scheme for leaves                                              
+        rightcolors  = ['"Grey080"','"Grey160"']*int(number_of_leaf_pairs/2)
+
+        leaf_num = number_of_leaf_pairs
+
+        if mode == "dynamic":
+            sequence = np.asarray(TransX, dtype = float)                                              #Replace the positions by references to the time features
+            TransX = [["Tf/LeftLeaf{}TransX/Value".format(i) for i in range(leaf_num)], \
+                ["Tf/RightLeaf{}TransX/Value".format(i) for i in reversed(range(leaf_num))]]
+
+        left_leaf  = left_leaf_parameters.format                                                      #Leaf templates with named fields, rendered into one buffer
+        right_leaf = right_leaf_parameters.format
+
+        document = [materials, mlcgroup.format(MLC_TransZ), \
+            placement_left.format(dist_from_xy_plane_to_top_edge), \
+            placement_right.format(dist_from_xy_plane_to_top_edge)]                                   #Header containing the MLC group information, materials etc.
+
+        if mode == "merged":                                                                          #Two pre-positioned meshes instead of 2 x N leaves
+            document += merged_banks(filename, leaf_stl_path, TransX, [TransY, TransYR], [TransZ, TransZR], [RotX, RotXR])
+            leaf_num = 0
+
+        for i in range(leaf_num):                                                                     #Position of each individual leaf
+            j = leaf_num-1-i
+
+            document += [left_leaf(i = i, TransX = TransX[0][i], TransY = TransY[i], TransZ = TransZ[i], \
+                RotX = RotX[i], InputFile = leaf_stl_path, Color = leftcolors[i]), \
+                right_leaf(i = i, TransX = TransX[1][j], TransY = TransYR[j], TransZ = TransZR[j], \
+                RotX = RotXR[j], InputFile = leaf_stl_path, Color = rightcolors[i])]
+
+        if mode == "dynamic":
+            document += [time_features(sequence, times)]                                              #Leaf movement over all control points
+
+    write_file(filename, "".join(document))                                                           #Single bulk write
+
+    return
+
+def write_file(filename, text):
+
+    """
+    A function that writes a simulation file. A file hard-linked from the output cache is
+    unlinked first, so writing never changes the cached geometry.
+    """
+
+    if os.path.isfile(filename) and os.stat(filename).st_nlink > 1:                                   #Never write through a hard link into the output cache
+        os.remove(filename)
+
+    with stage("write"), open(filename,"w+") as file:
+        file.write(text)
+
+    return
+
+def leaf_layout(number_of_leaf_pairs, leaf_pitch = 2, profile = None):
+
+    """
+    A function that returns the TransY (mm), TransZ (cm) and RotX (deg) lists of the leaves.
+    Change these to reflect leaf bank rotation and the vertical position of the leaves, or
+    pass a machine profile with pitch zones, focused and tilted leaves (see machine_profiles.py).
+    """
+
+    if profile is not None:                                                                           #Compiled once per profile
+        layout = compile_profile(profile)
+
+        if len(layout["TransY"]) != number_of_leaf_pairs:
+            raise ValueError("The machine profile defines {} leaf pairs, not {}".format(len(layout["TransY"]), number_of_leaf_pairs))
+
+        return layout["TransY"].tolist(), layout["TransZ"].tolist(), layout["RotX"].tolist()
+
+    TransY  = [leaf_pitch*i+leaf_pitch/2 for i in range(-int(number_of_leaf_pairs/2),int(number_of_leaf_pairs/2))]  #Space between leaves
+    TransZ  = [0 for i in range(-int(number_of_leaf_pairs/2),int(number_of_leaf_pairs/2))]            #Rotation correction - example: [5*np.cos(0.005*i) for i in range(-int(number_of_leaf_pairs/2),int(number_of_leaf_pairs/2))]
+    RotX    = [180 for i in range(number_of_leaf_pairs)]                                              #Leaf angles - example: np.linspace(168,192,number_of_leaf_pairs).tolist()
+
+    return TransY, TransZ, RotX
+
+def merged_banks(filename, leaf_stl_path, TransX, TransY, TransZ, RotX):
+
+    """
+    A function that writes one merged, pre-positioned .stl file per leaf bank next to
+    filename and returns the parameters of the two according TsCAD components. TransY,
+    TransZ and RotX hold the layout of both banks (2 x N_pairs), ordered like TransX.
+    """
+
+    with stage("stl"):
+        leaf = read_stl(leaf_stl_path)
+
+    stem = os.path.splitext(filename)[0]
+    TransZ = 10*np.asarray(TransZ, dtype = float)                                                     #TransZ is given in cm, the mesh in mm
+
+    banks = []
+
+    for bank, transx, template in ((0, TransX[0], left_bank_parameters), (1, TransX[1], right_bank_parameters)):
+        bank_stl_path = stem + ("_left.stl", "_right.stl")[bank]
+        with stage("stl"):
+            write_stl(bank_stl_path, place_leaves(leaf, transx, TransY[bank], TransZ[bank], RotX[bank]))
+        banks += [template.format(InputFile = bank_stl_path)]
+
+    return banks
+
+def step_times(weights, duration):
+
+    """
+    A function that returns the end time (ms) of every control point step of a sequence
+    lasting duration ms, with step durations in proportion to the MU weights.
+    """
+
+    cumulative = np.cumsum(weights, dtype = float)
+
+    if cumulative[-1] <= 0:
+        raise ValueError("The weights of the sequence sum up to {}".format(cumulative[-1]))
+
+    return np.round(duration*cumulative/cumulative[-1], 6)
+
+def time_features(sequence, times = None):
+
+    """
+    A function that creates the TOPAS time features moving every leaf through a
+    control point sequence of shape (N_controlpoints x 2 x N_pairs). times are the
+    end times (ms) of the control point steps, whole numbers are written without decimals.
+    """
+
+    number_of_control_points, _, leaf_num = sequence.shape
+
+    if times is None:
+        times = 10*np.arange(1, number_of_control_points+1)                                           #End time of each control point step in ms
+
+    times = " ".join(np.format_float_positional(t, trim = "-") for t in np.asarray(times, dtype = float))
+    features = [timeline.format(number_of_control_points, times.split()[-1])]
+
+    feature = leaf_time_feature.format
+
+    for i in range(leaf_num):
+        left  = " ".join(map(str, sequence[:, 0, i].tolist()))
+        right = " ".join(map(str, sequence[:, 1, leaf_num-1-i].tolist()))
+
+        features += [feature(leaf = "LeftLeaf{}".format(i), count = number_of_control_points, times = times, values = left), \
+            feature(leaf = "RightLeaf{}".format(i), count = number_of_control_points, times = times, values = right)]
+
+    return "".join(features)
+
+def CreateTopasMLCIncludeFiles(filename, leaf_stl_path, number_of_leaf_pairs, \
+    dist_from_xy_plane_to_top_edge, MLC_TransZ, TransX, overrides = None, \
+    materials = materials, mlcgroup = mlcgroup, placement_left = placement_left, \
+    placement_right = placement_right, leaf_pitch = 2, profile = None):
+
+    """
+    A function that writes the shared base file for a control point sequence and one
+    file per control point that includes the base and overrides the changing values.
+    """
+
+    sequence = np.asarray(TransX, dtype = float)
+    leaf_num = number_of_leaf_pairs
+
+    CreateTopasMLCFile(filename, leaf_stl_path, number_of_leaf_pairs, dist_from_xy_plane_to_top_edge, \
+        MLC_TransZ, sequence[0].tolist(), materials, mlcgroup, placement_left, placement_right, \
+        leaf_pitch = leaf_pitch, profile = profile)                                                   #Base file containing the complete geometry
+
+    values = {"TransX": sequence}                                                                     #Parameters overridden for every control point
+    values.update({key: np.asarray(value, dtype = float) for key, value in (overrides or {}).items()})
+
+    stem, extension = os.path.splitext(filename)
+    filenames = output_filenames(stem + "_{index:04d}" + extension, len(sequence))
+
+    for c, controlpoint_filename in enumerate(filenames):
+        with stage("render"):
+            lines = [include_file.format(filename)]
+
+            for i in range(leaf_num):
+                lines += [left_leaf_override.format(i, key, value[c][0][i], override_units[key]) \
+                    for key, value in values.items()]
+                lines += [right_leaf_override.format(i, key, value[c][1][leaf_num-1-i], override_units[key]) \
+                    for key, value in values.items()]
+
+        write_file(controlpoint_filename, "".join(lines))
+
+    return filenames
+
+def cli(argv = None):
+
+    """
+    Command line entry point: loads leaf positions from a file or directory and creates
+    the according simulation files without importing any GUI components.
+    """
+
+    parser = argparse.ArgumentParser(description = "Create TOPAS MLC simulation files from leaf positions.")
+    parser.add_argument("input", help = "stacked .txt, .npy/.npz file, RT Plan (.dcm) or directory of leaf positions")
+    parser.add_argument("workers", nargs = "?", type = int, default = 1, help = "number of worker processes")
+    parser.add_argument("-o", "--output", default = "DICOM_MLC_POS.txt", help = "output file name, may contain {index}")
+    parser.add_argument("-m", "--mode", default = "static", choices = ["static", "dynamic", "include", "merged"])
+    parser.add_argument("-t", "--tolerance", type = float, help = "merge consecutive control points within this tolerance (cm)")
+    parser.add_argument("-s", "--segments", type = int, help = "resample the sequence to this number of segments")
+    parser.add_argument("-c", "--cache", help = "directory of the output cache for unchanged geometries")
+    parser.add_argument("--weights", help = ".txt file with the MU of every control point (default: RT Plan MU or 1)")
+    parser.add_argument("--times", help = ".txt file with the end time (ms) of every control point step")
+    parser.add_argument("--limits", help = ".json file with the leaf sequence limits, see leaf_validation.default_limits")
+    parser.add_argument("-p", "--profile", help = "machine profile (name or .json file) with the leaf layout")
+    parser.add_argument("--timings", nargs = "?", const = "", metavar = "JSON", \
+        help = "print the time spent per stage, optionally also save it as .json file")
+    parser.add_argument("--timings-memory", action = "store_true", help = "also measure the peak allocations per stage")
+    args = parser.parse_args(argv)
+
+    if args.timings is not None or args.timings_memory:
+        profiling.enable(args.timings_memory)
+
+    if not os.path.exists(args.input):
+        parser.error("No such file or directory: " + args.input)
+
+    setup = machine_setup()
+
+    if args.profile is not None:                                                                      #The profile also defines the number of leaf pairs
+        setup = dict(setup, profile = args.profile, number_of_leaf_pairs = len(compile_profile(args.profile)["TransY"]))
+
+    limits = None
+
+    if args.limits is not None:
+        with open(args.limits) as file:
+            limits = json.load(file)
+
+    load_mlc_data(args.input, args.output, args.workers, args.mode, limits, tolerance = args.tolerance, \
+        segments = args.segments, setup = setup, cache = args.cache, \
+        weights = None if args.weights is None else np.loadtxt(args.weights, ndmin = 1), \
+        times = None if args.times is None else np.loadtxt(args.times, ndmin = 1))
+
+    if profiling.enabled:                                                                             #Also when enabled by the environment variable
+        print(profiling.format_report(), file = sys.stderr)
+        if args.timings or os.environ.get(profiling.report_variable):
+            profiling.save_report(args.timings or os.environ[profiling.report_variable])
+        profiling.disable()
+
+    return
+
+if __name__ == "__main__":
+    sys.exit(cli())
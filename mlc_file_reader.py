@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""
+Reading generated TOPAS MLC files back into arrays and patching their TransX values.
+"""
+
+import os
+import re
+import numpy as np
+
+
+leaf_parameter = re.compile(r"^d:Ge/(Left|Right)Leaf(\d+)/(TransX|TransY|TransZ|RotX)([ \t]*=[ \t]*)(\S+)", re.MULTILINE)
+include_statement = re.compile(r"^includeFile\s*=\s*(.+?)\s*$", re.MULTILINE)
+
+banks = {"Left": 0, "Right": 1}
+
+def read_mlc_file(path, follow_includes = True):
+
+    """
+    A function that reads a simulation file created by CreateTopasMLCFile() back into
+    arrays in a single pass. Returns a dictionary with the TransX (mm), TransY (mm),
+    TransZ (cm) and RotX (deg) values of shape (2 x N_pairs), indexed like the leaf
+    components, i.e. [1][i] belongs to RightLeaf{i}. CreateTopasMLCFile() expects the
+    right bank TransX reversed: [TransX[0], TransX[1][::-1]]. Values that are not numbers,
+    e.g. time feature references, are NaN. With follow_includes, files included with
+    includeFile are read first and overridden by the including file.
+    """
+
+    values = _read_values(path, follow_includes)
+
+    number_of_leaf_pairs = max((index for _, _, index in values), default = -1) + 1
+    parameters = {name: np.full((2, number_of_leaf_pairs), np.nan) for name in ("TransX", "TransY", "TransZ", "RotX")}
+
+    for (parameter, bank, index), value in values.items():
+        parameters[parameter][bank, index] = value
+
+    return parameters
+
+def _read_values(path, follow_includes = True):
+
+    """
+    A function that collects the leaf parameters of a file as {(parameter, bank, leaf): value}.
+    """
+
+    with open(path) as file:
+        text = file.read()
+
+    values = {}
+
+    if follow_includes:
+        for include in include_statement.findall(text):
+            included = include.strip('"')
+            if not os.path.isabs(included) and not os.path.exists(included):                          #Relative to the including file as a fallback
+                included = os.path.join(os.path.dirname(path), included)
+            values.update(_read_values(included))
+
+    for bank, index, parameter, _, value in leaf_parameter.findall(text):
+        values[(parameter, banks[bank], int(index))] = _number(value)
+
+    return values
+
+def _number(value):
+
+    """
+    A function that converts a parameter value, returning NaN for references.
+    """
+
+    try:
+        return float(value)
+    except ValueError:
+        return np.nan
+
+def patch_transx(path, TransX, decimals = 3):
+
+    """
+    A function that updates the leaf TransX values of an existing simulation file in place.
+    TransX has the shape (2 x N_pairs) and is indexed like the leaf components, see
+    read_mlc_file(). Only the lines of leaves whose rounded position changed are rewritten;
+    NaN entries are left untouched. The file is replaced atomically. Returns the number of
+    changed lines.
+    """
+
+    TransX = np.round(np.asarray(TransX, dtype = float), decimals)
+
+    with open(path) as file:
+        text = file.read()
+
+    pieces = []
+    position = 0
+
+    for match in leaf_parameter.finditer(text):
+        bank, index, parameter = banks[match.group(1)], int(match.group(2)), match.group(3)
+
+        if parameter != "TransX" or index >= TransX.shape[1] or np.isnan(TransX[bank, index]):
+            continue
+
+        if _number(match.group(5)) != TransX[bank, index]:                                            #Replace only the value of changed leaves
+            pieces += [text[position:match.start(5)], str(TransX[bank, index].item())]
+            position = match.end(5)
+
+    if not pieces:
+        return 0
+
+    pieces += [text[position:]]
+
+    temporary = path + ".{}.tmp".format(os.getpid())
+    with open(temporary, "w") as file:
+        file.write("".join(pieces))
+    os.replace(temporary, path)                                                                       #Also detaches the file from hard-linked cache entries
+
+    return len(pieces)//2
+
+def diff_mlc_files(first, second):
+
+    """
+    A function that compares two simulation files and returns, per parameter, the indices
+    (bank, leaf) of the leaves that differ and their values in both files.
+    """
+
+    a, b = read_mlc_file(first), read_mlc_file(second)
+    differences = {}
+
+    for name in a:
+        if a[name].shape != b[name].shape:
+            differences[name] = {"shape": (a[name].shape, b[name].shape)}
+            continue
+
+        changed = np.argwhere(~((a[name] == b[name]) | (np.isnan(a[name]) & np.isnan(b[name]))))
+        if len(changed):
+            differences[name] = {"leaves": changed.tolist(), "first": a[name][tuple(changed.T)].tolist(), \
+                "second": b[name][tuple(changed.T)].tolist()}
+
+    return differences
@@ -0,0 +1,382 @@
+# -*- coding: utf-8 -*-
+"""
+Long-running generation service answering jobs over a Unix socket or localhost HTTP.
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import argparse
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+import profiling
+from mlc_core import machine_setup, calibrate_from_stl, compile_profile, load_mlc_data
+
+
+input_extensions = (".txt", ".npy", ".npz", ".dcm")                                                   #Plan files picked up in watch mode
+http_host = "127.0.0.1"                                                                               #Jobs are not authenticated and write any path, so HTTP only listens on localhost
+
+_setups = {}
+
+def resolve_setup(overrides = None):
+
+    """
+    A function that returns the machine configuration of a job: machine_setup() with the
+    values given in overrides. Offsets and the leaf pitch of a different leaf .stl file are
+    measured from that file, unless given. Configurations are kept per overrides and
+    .stl file version, so every configuration is only read once.
+    """
+
+    overrides = overrides or {}
+    stl = overrides.get("leaf_stl_path")
+    version = (os.stat(stl).st_mtime_ns, os.stat(stl).st_size) if stl and os.path.isfile(stl) else None
+    key = (json.dumps(overrides, sort_keys = True), version)
+
+    if key not in _setups:
+        setup = dict(machine_setup(), **overrides)
+
+        if stl is not None:                                                                           #Measure the values not given for the new .stl file
+            setup["dist_from_xy_plane_to_top_edge"], setup["dist_from_z_axis_to_inner_edge"], setup["leaf_pitch"] = \
+                calibrate_from_stl(stl, overrides.get("dist_from_xy_plane_to_top_edge"), \
+                overrides.get("dist_from_z_axis_to_inner_edge"), overrides.get("leaf_pitch"))
+
+        if setup.get("profile") is not None and "number_of_leaf_pairs" not in overrides:              #The profile defines the number of leaf pairs
+            setup["number_of_leaf_pairs"] = len(compile_profile(setup["profile"])["TransY"])
+
+        _setups[key] = setup
+
+    return _setups[key]
+
+def run_job(job, setup):
+
+    """
+    A function that creates the simulation files of a job in a worker process and returns
+    the written files, the run time and, if requested, the time spent per stage.
+    """
+
+    start = time.perf_counter()
+
+    enabled = job.get("timings") and not profiling.enabled                                            #Profiling enabled by TOPAS_MLC_PROFILE stays enabled
+
+    if enabled:
+        profiling.reset()
+        profiling.enable()
+
+    try:
+        input = np.asarray(job["leaf_positions"], dtype = float) if "leaf_positions" in job else job["input"]
+
+        if not isinstance(input, np.ndarray) and not os.path.exists(input):
+            raise FileNotFoundError("No such file or directory: " + str(input))
+
+        files = load_mlc_data(input, job.get("output", "DICOM_MLC_POS.txt"), 1, job.get("mode", "static"), \
+            job.get("limits"), job.get("tolerance"), job.get("segments"), setup, job.get("cache"), \
+            job.get("weights"), job.get("times"))
+
+    finally:
+        timings = profiling.report() if job.get("timings") else None
+        if enabled:
+            profiling.disable()
+
+    result = {"files": files, "seconds": time.perf_counter() - start}
+
+    if timings is not None:
+        result["timings"] = timings
+
+    return result
+
+class Service:
+
+    """
+    A class describing the long-running generation service. Jobs are queued on the asyncio
+    loop; a bounded queue limits the number of waiting jobs and a pool of worker processes,
+    started once and kept alive, creates the files. A job is a dictionary with
+    - input : path of a leaf position file or directory, or
+    - leaf_positions : nested list of leaf positions (N_controlpoints x N_pairs x 2)
+    - output, mode, limits, tolerance, segments, cache, weights, times : see load_mlc_data(), optional
+    - setup : values overriding machine_setup(), optional
+    - timings : also return the time spent per stage, optional
+    - id : returned unchanged, optional
+    """
+
+    def __init__(self, workers = None, queue_size = 64):
+
+        self.workers = workers or os.cpu_count() or 1
+        self.queue_size = queue_size
+        self.completed = 0
+        self.failed = 0
+        self.tasks = set()                                                                            #Running watch jobs, referenced until they are done
+
+    async def start(self):
+
+        """
+        A method that starts the worker processes and the dispatchers.
+        """
+
+        self.queue = asyncio.Queue(self.queue_size)
+        self.pool = ProcessPoolExecutor(max_workers = self.workers)
+        loop = asyncio.get_running_loop()
+
+        await asyncio.gather(*[loop.run_in_executor(self.pool, int) for _ in range(self.workers)])    #Start all workers now, not with the first jobs
+        self.dispatchers = [asyncio.create_task(self._dispatch()) for _ in range(self.workers)]
+
+    async def stop(self):
+
+        for task in self.dispatchers + list(self.tasks):
+            task.cancel()
+
+        self.pool.shutdown()
+
+    async def submit(self, job):
+
+        """
+        A method that queues a job, waiting while the queue is full, and returns its result.
+        """
+
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((job, time.perf_counter(), future))
+
+        return await future
+
+    async def _dispatch(self):
+
+        loop = asyncio.get_running_loop()
+
+        while True:
+            job, queued, future = await self.queue.get()
+            waited = time.perf_counter() - queued
+
+            try:
+                setup = await loop.run_in_executor(None, resolve_setup, job.get("setup"))            #Measuring a new .stl file must not block the clients
+                result = await loop.run_in_executor(self.pool, run_job, job, setup)
+                result.update({"ok": True, "queued": waited})
+                self.completed += 1
+            except Exception as error:
+                result = {"ok": False, "error": "{}: {}".format(type(error).__name__, error), "queued": waited}
+                self.failed += 1
+
+            if "id" in job:
+                result["id"] = job["id"]
+
+            if not future.cancelled():
+                future.set_result(result)
+
+            self.queue.task_done()
+
+    def status(self):
+
+        return {"workers": self.workers, "queued": self.queue.qsize(), "queue_size": self.queue_size, \
+            "completed": self.completed, "failed": self.failed}
+
+    async def handle_stream(self, reader, writer):
+
+        """
+        A method serving one socket connection: every line is a job (JSON), answered by one
+        line with its result. The line "status" returns the state of the service.
+        """
+
+        try:
+            while True:
+                line = await reader.readline()
+
+                if not line:
+                    break
+
+                if line.strip() == b"status":
+                    result = self.status()
+                else:
+                    try:
+                        result = await self.submit(json.loads(line))
+                    except ValueError as error:
+                        result = {"ok": False, "error": "Invalid job: {}".format(error)}
+
+                writer.write(json.dumps(result).encode() + b"\n")
+                await writer.drain()
+
+        finally:
+            writer.close()
+
+    async def handle_http(self, reader, writer):
+
+        """
+        A method serving one HTTP request: POST /jobs with a job (JSON) as body, or GET /status.
+        """
+
+        try:
+            request = (await reader.readline()).decode("latin-1").split()
+            headers = {}
+
+            while True:
+                line = (await reader.readline()).decode("latin-1").strip()
+                if not line:
+                    break
+                name, _, value = line.partition(":")
+                headers[name.strip().lower()] = value.strip()
+
+            body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+            if request[:2] == ["GET", "/status"]:
+                status, result = "200 OK", self.status()
+            elif request[:2] == ["POST", "/jobs"]:
+                try:
+                    result = await self.submit(json.loads(body))
+                    status = "200 OK" if result["ok"] else "422 Unprocessable Entity"
+                except ValueError as error:
+                    status, result = "400 Bad Request", {"ok": False, "error": "Invalid job: {}".format(error)}
+            else:
+                status, result = "404 Not Found", {"ok": False, "error": "Use POST /jobs or GET /status"}
+
+            response = json.dumps(result).encode()
+            writer.write("HTTP/1.1 {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\nConnection: close\r\n\r\n" \
+                .format(status, len(response)).encode() + response)
+            await writer.drain()
+
+        except (IndexError, ValueError, asyncio.IncompleteReadError):
+            pass
+
+        finally:
+            writer.close()
+
+    async def watch(self, directory, output_dir, interval = 1, defaults = None):
+
+        """
+        A method that polls directory for new plan files and creates their simulation files
+        in output_dir/<name>/. A file is picked up once its size stopped changing; the
+        results are written to output_dir/<name>/result.json.
+        """
+
+        seen, sizes = {}, {}
+
+        while True:
+            for entry in os.scandir(directory):
+                if not entry.is_file() or os.path.splitext(entry.name)[1].lower() not in input_extensions:
+                    continue
+
+                status = entry.stat()
+                version = (status.st_mtime_ns, status.st_size)
+
+                if seen.get(entry.path) == version:
+                    continue
+
+                if sizes.get(entry.path) != status.st_size:                                          #Still being written, check again next time
+                    sizes[entry.path] = status.st_size
+                    continue
+
+                seen[entry.path] = version
+                name = os.path.splitext(entry.name)[0]
+                os.makedirs(os.path.join(output_dir, name), exist_ok = True)
+
+                job = dict(defaults or {}, input = entry.path, output = os.path.join(output_dir, name, name + ".txt"))
+                task = asyncio.create_task(self._watch_job(job, os.path.join(output_dir, name, "result.json")))
+                self.tasks.add(task)
+                task.add_done_callback(self._watch_done)
+
+            await asyncio.sleep(interval)
+
+    def _watch_done(self, task):
+
+        self.tasks.discard(task)
+
+        if not task.cancelled() and task.exception() is not None:
+            print("Watch job failed: {}: {}".format(type(task.exception()).__name__, task.exception()), file = sys.stderr)
+
+    async def _watch_job(self, job, result_path):
+
+        result = await self.submit(job)
+
+        with open(result_path, "w") as file:
+            json.dump(result, file, indent = 2)
+
+        print("{}: {}".format(job["input"], "{} files".format(len(result["files"])) if result["ok"] else result["error"]))
+
+def request(job, socket_path = None, port = None):
+
+    """
+    A function that sends a job (dictionary) to a running service, either on a Unix socket
+    or via HTTP on the local port, and returns the result.
+    """
+
+    if socket_path is not None:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+            connection.connect(socket_path)
+            connection.sendall(json.dumps(job).encode() + b"\n")
+            with connection.makefile("rb") as file:
+                return json.loads(file.readline())
+
+    body = json.dumps(job).encode()
+
+    with socket.create_connection((http_host, port)) as connection:
+        connection.sendall("POST /jobs HTTP/1.1\r\nHost: {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\n\r\n" \
+            .format(http_host, len(body)).encode() + body)
+        with connection.makefile("rb") as file:
+            response = file.read()
+
+    return json.loads(response.split(b"\r\n\r\n", 1)[1])
+
+async def serve(socket_path = None, port = None, workers = None, queue_size = 64, \
+    watch = None, watch_output = "generated", interval = 1, defaults = None):
+
+    """
+    A function that runs the service until it is interrupted.
+    """
+
+    service = Service(workers, queue_size)
+    await service.start()
+    tasks = []
+
+    if socket_path is not None:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = await asyncio.start_unix_server(service.handle_stream, socket_path)
+        tasks += [server.serve_forever()]
+        print("Listening on " + socket_path)
+
+    if port is not None:
+        server = await asyncio.start_server(service.handle_http, http_host, port)
+        tasks += [server.serve_forever()]
+        print("Listening on http://{}:{}".format(http_host, port))
+
+    if watch is not None:
+        tasks += [service.watch(watch, watch_output, interval, defaults)]
+        print("Watching " + watch)
+
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        await service.stop()
+        if socket_path is not None and os.path.exists(socket_path):
+            os.remove(socket_path)
+
+def main(argv = None):
+
+    """
+    Command line entry point: starts the generation service.
+    """
+
+    parser = argparse.ArgumentParser(description = "Serve TOPAS MLC file generation from a warm process.")
+    parser.add_argument("-s", "--socket", help = "path of the Unix socket to listen on")
+    parser.add_argument("-p", "--port", type = int, help = "port for HTTP on localhost")
+    parser.add_argument("-w", "--workers", type = int, help = "number of worker processes (default: all CPUs)")
+    parser.add_argument("-q", "--queue-size", type = int, default = 64, help = "maximum number of waiting jobs")
+    parser.add_argument("--watch", help = "directory to watch for plan files")
+    parser.add_argument("--watch-output", default = "generated", help = "directory for the files created in watch mode")
+    parser.add_argument("--interval", type = float, default = 1, help = "polling interval of the watch mode in s")
+    parser.add_argument("-m", "--mode", default = "static", choices = ["static", "dynamic", "include", "merged"], \
+        help = "mode of the files created in watch mode")
+    args = parser.parse_args(argv)
+
+    if args.socket is None and args.port is None and args.watch is None:
+        parser.error("Give at least one of --socket, --port or --watch")
+
+    try:
+        asyncio.run(serve(args.socket, args.port, args.workers, args.queue_size, \
+            args.watch, args.watch_output, args.interval, {"mode": args.mode}))
+    except KeyboardInterrupt:
+        pass
+
+    return
+
+if __name__ == "__main__":
+    sys.exit(main())
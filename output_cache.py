@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+"""
+Content-addressed cache of generated simulation files.
+"""
+
+import os
+import shutil
+import hashlib
+import numpy as np
+import mlc_core
+from leaf_stl import file_hash
+from profiling import stage
+
+
+cache_dir = os.path.join(os.path.expanduser("~"), ".cache", "topas-custom-mlc", "geometries")         #Location of the cached simulation files
+max_cache_size = 2*1024**3                                                                            #Cache size in bytes before the least recently used files are removed
+evict_to = 0.9                                                                                        #Fraction of max_cache_size left after an eviction, so evictions stay rare
+
+_stl_hashes = {}
+_cache_sizes = {}                                                                                     #Size of every cache directory, scanned once per process and then counted up
+
+def stl_hash(leaf_stl_path):
+
+    """
+    A function that returns the hash of the leaf .stl file, remembered per path, size
+    and modification time so the mesh is only read once per process.
+    """
+
+    if not os.path.isfile(leaf_stl_path):
+        return ""
+
+    status = os.stat(leaf_stl_path)
+    key = (os.path.abspath(leaf_stl_path), status.st_size, status.st_mtime_ns)
+
+    if key not in _stl_hashes:
+        _stl_hashes[key] = file_hash(leaf_stl_path)
+
+    return _stl_hashes[key]
+
+def geometry_key(leaf_stl_path, number_of_leaf_pairs, dist_from_xy_plane_to_top_edge, MLC_TransZ, TransX, \
+    mode = "static", times = None, leaf_pitch = 2, profile = None, overrides = None, **templates):
+
+    """
+    A function that returns the content hash identifying a simulation file: the rounded
+    leaf positions, the MLC configuration, the leaf layout including the layout overrides
+    of both banks, the leaf .stl file and the templates used.
+    """
+
+    sha = hashlib.sha256()
+    TransX = np.round(np.asarray(TransX, dtype = float), 3)
+
+    for value in (leaf_stl_path, stl_hash(leaf_stl_path), number_of_leaf_pairs, dist_from_xy_plane_to_top_edge, \
+        MLC_TransZ, mode, leaf_pitch, TransX.shape, None if times is None else np.asarray(times).tolist()):
+        sha.update(repr(value).encode() + b"\0")
+
+    sha.update(TransX.tobytes())
+
+    for array in mlc_core.leaf_layout(number_of_leaf_pairs, leaf_pitch, profile):                     #Compiled layout, so edited profiles are new geometries
+        sha.update(np.asarray(array, dtype = float).tobytes())
+
+    for name, array in sorted((overrides or {}).items()):                                             #Per bank layout, e.g. tilted banks
+        array = np.asarray(array, dtype = float)
+        sha.update(repr((name, array.shape)).encode() + b"\0" + array.tobytes())
+
+    for name in ("materials", "mlcgroup", "placement_left", "placement_right"):
+        sha.update(templates.get(name, getattr(mlc_core, name)).encode() + b"\0")
+
+    for name in ("left_leaf_parameters", "right_leaf_parameters", "timeline", "leaf_time_feature"):
+        sha.update(getattr(mlc_core, name).encode() + b"\0")
+
+    return sha.hexdigest()
+
+def CreateCachedTopasMLCFile(filename, leaf_stl_path, number_of_leaf_pairs, dist_from_xy_plane_to_top_edge, \
+    MLC_TransZ, TransX, cache_dir = cache_dir, max_cache_size = max_cache_size, **kwargs):
+
+    """
+    A function with the same arguments as CreateTopasMLCFile() that only renders a file if
+    the identical geometry is not in the cache yet. Otherwise, the cached file is hard-linked
+    (or copied, if linking is not possible) to filename. Only single-file modes ("static",
+    "dynamic") can be cached and the leaf positions are rounded to 3 decimals, like
+    calculate_transx() does. Returns True for a cache hit.
+    """
+
+    if kwargs.get("mode", "static") not in ("static", "dynamic"):
+        raise ValueError("Only the static and dynamic modes can be cached")
+
+    with stage("cache"):
+        TransX = np.round(np.asarray(TransX, dtype = float), 3).tolist()
+        templates = {key: value for key, value in kwargs.items() if key in ("materials", "mlcgroup", "placement_left", "placement_right")}
+        key = geometry_key(leaf_stl_path, number_of_leaf_pairs, dist_from_xy_plane_to_top_edge, MLC_TransZ, TransX, \
+            kwargs.get("mode", "static"), kwargs.get("times"), kwargs.get("leaf_pitch", 2), kwargs.get("profile"), \
+            kwargs.get("overrides"), **templates)
+
+    cached = os.path.join(cache_dir, key[:2], key + ".txt")
+    hit = os.path.isfile(cached)
+
+    if hit:
+        os.utime(cached)                                                                              #Mark as recently used
+
+    else:
+        os.makedirs(os.path.dirname(cached), exist_ok = True)
+        temporary = cached + ".{}.tmp".format(os.getpid())
+        mlc_core.CreateTopasMLCFile(temporary, leaf_stl_path, number_of_leaf_pairs, dist_from_xy_plane_to_top_edge, \
+            MLC_TransZ, TransX, **kwargs)
+        os.replace(temporary, cached)                                                                 #Never expose half-written files to other processes
+
+    if os.path.lexists(filename):
+        os.remove(filename)
+
+    try:
+        os.link(cached, filename)
+    except OSError:                                                                                   #E.g. a different file system
+        shutil.copyfile(cached, filename)
+
+    if not hit:
+        track_size(cache_dir, os.stat(cached).st_size, max_cache_size)
+
+    return hit
+
+def track_size(cache_dir, added, max_cache_size = max_cache_size):
+
+    """
+    A function that adds the size of a new file to the cache size and evicts files once the
+    cache exceeds max_cache_size bytes. The cache directory is only scanned on the first
+    call and for evictions; files added by other processes are counted by their next scan.
+    """
+
+    directory = os.path.abspath(cache_dir)
+
+    if directory not in _cache_sizes:                                                                 #The new file is included in the scan
+        _cache_sizes[directory] = cache_size(cache_dir)
+    else:
+        _cache_sizes[directory] += added
+
+    if _cache_sizes[directory] > max_cache_size:
+        _cache_sizes[directory] = evict(cache_dir, max_cache_size, evict_to*max_cache_size)
+
+    return _cache_sizes[directory]
+
+def cached_files(cache_dir = cache_dir):
+
+    """
+    A function that returns the files in the cache and their os.stat() results.
+    """
+
+    files = [entry for directory in os.scandir(cache_dir) if directory.is_dir() \
+        for entry in os.scandir(directory.path) if entry.name.endswith(".txt")]
+
+    return files, [entry.stat() for entry in files]
+
+def cache_size(cache_dir = cache_dir):
+
+    """
+    A function that returns the size of all files in the cache in bytes.
+    """
+
+    return sum(s.st_size for s in cached_files(cache_dir)[1])
+
+def evict(cache_dir = cache_dir, max_cache_size = max_cache_size, target_size = None):
+
+    """
+    A function that removes the least recently used files once the cache is larger than
+    max_cache_size bytes, until it is smaller than target_size (default: max_cache_size).
+    Returns the remaining cache size.
+    """
+
+    files, status = cached_files(cache_dir)
+    size = sum(s.st_size for s in status)
+    target_size = max_cache_size if target_size is None else target_size
+
+    if size <= max_cache_size:
+        return size
+
+    for index in np.argsort([s.st_mtime_ns for s in status]):                                         #Oldest first
+        if size <= target_size:
+            break
+
+        os.remove(files[index].path)
+        size -= status[index].st_size
+
+    return size
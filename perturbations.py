@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+"""
+Perturbed plan variants for sensitivity and robustness analyses.
+"""
+
+import os
+import sys
+import json
+import argparse
+import numpy as np
+from functools import partial
+from mlc_core import machine_setup, load_control_points, output_filenames, leaf_layout, \
+    compile_profile, Projection, CreateTopasMLCFile
+from profiling import stage
+
+
+error_types = ("shift", "gap", "leaf", "tilt", "height")                                              #Sampled in this order, so a seed always gives the same variants
+
+def sample_errors(error, rng, shape):
+
+    """
+    A function that samples an error distribution for the given shape. error may be None
+    (no error), a number (standard deviation of a normal distribution around 0) or a
+    dictionary {"distribution": "normal", "mean": 0, "sd": ...} or
+    {"distribution": "uniform", "low": ..., "high": ...}.
+    """
+
+    if error is None:
+        return np.zeros(shape)
+
+    if not isinstance(error, dict):
+        error = {"sd": error}
+
+    distribution = error.get("distribution", "normal")
+
+    if distribution == "normal":
+        return rng.normal(error.get("mean", 0), error.get("sd", 0), shape)
+
+    if distribution == "uniform":
+        return rng.uniform(error["low"], error["high"], shape)
+
+    raise ValueError("Unknown error distribution: " + str(distribution))
+
+def sample_perturbations(number_of_variants, number_of_controlpoints, number_of_leaf_pairs, errors, seed = 0):
+
+    """
+    A function that samples the perturbations of number_of_variants plan variants at once.
+    errors maps every error type to its distribution (see sample_errors()), missing types
+    are not applied:
+    - shift : systematic shift of each leaf bank in cm (N_variants x 2)
+    - gap : systematic change of every leaf gap in cm, split between both banks (N_variants)
+    - leaf : random error of every leaf and control point in cm (N_variants x N_controlpoints x N_pairs x 2)
+    - tilt : tilt of each leaf bank about the direction of leaf motion in deg (N_variants x 2)
+    - height : vertical shift of each leaf bank in cm (N_variants x 2)
+    Returns a dictionary of the sampled arrays. The same seed gives the same variants.
+    """
+
+    rng = np.random.default_rng(seed)
+    shapes = {"shift": (number_of_variants, 2), "gap": (number_of_variants,), \
+        "leaf": (number_of_variants, number_of_controlpoints, number_of_leaf_pairs, 2), \
+        "tilt": (number_of_variants, 2), "height": (number_of_variants, 2)}
+
+    unknown = set(errors) - set(error_types)
+
+    if unknown:
+        raise ValueError("Unknown error types: " + ", ".join(sorted(unknown)))
+
+    return {name: sample_errors(errors.get(name), rng, shapes[name]) for name in error_types}
+
+def perturb(leaf_positions, perturbations):
+
+    """
+    A function that applies the sampled perturbations (see sample_perturbations()) to a
+    sequence of leaf pair positions (N_controlpoints x N_pairs x 2) and returns the
+    positions of all variants (N_variants x N_controlpoints x N_pairs x 2). Leaves pushed
+    past the opposing leaf close at the middle of both.
+    """
+
+    positions = np.sort(np.asarray(leaf_positions, dtype = float), axis = -1)                        #First column: left bank
+
+    positions = positions + perturbations["shift"][:, np.newaxis, np.newaxis, :] \
+        + perturbations["gap"][:, np.newaxis, np.newaxis, np.newaxis]*[-0.5, 0.5] + perturbations["leaf"]
+
+    crossed = positions[..., 0] > positions[..., 1]
+    positions[crossed] = positions[crossed].mean(axis = -1, keepdims = True)
+
+    return positions
+
+def bank_layouts(perturbations, number_of_leaf_pairs, leaf_pitch = 2, profile = None):
+
+    """
+    A function that returns the leaf layout of both banks of every variant as overrides
+    for CreateTopasMLCFile(), {"TransY", "TransZ", "RotX": (N_variants x 2 x N_pairs)}. A
+    bank tilt rotates the whole bank about its centre, so TransY and TransZ of the leaves
+    change together with RotX; height moves the bank vertically. Returns None if neither
+    tilt nor height is perturbed.
+    """
+
+    tilt, height = perturbations["tilt"], perturbations["height"]
+
+    if not tilt.any() and not height.any():                                                           #Nominal layout, the files stay identical to the plain ones
+        return None
+
+    TransY, TransZ, RotX = (np.asarray(values, dtype = float) for values in leaf_layout(number_of_leaf_pairs, leaf_pitch, profile))
+
+    angle = np.radians(tilt)[..., np.newaxis]                                                         #(N_variants x 2 x 1)
+    cos, sin = np.cos(angle), np.sin(angle)
+    z = 10*TransZ                                                                                     #TransZ is given in cm, TransY in mm
+
+    layout = {"TransY": TransY*cos + z*sin, \
+        "TransZ": (z*cos - TransY*sin)/10 + height[..., np.newaxis], \
+        "RotX": RotX + np.degrees(angle)}                                                             #Placements rotate the frame, see leaf_stl.place_leaves()
+
+    return {key: np.round(value, 6) for key, value in layout.items()}
+
+def write_variant(filenames, TransX, overrides, setup, mode = "static"):
+
+    """
+    A function that writes the simulation files of one variant, one file per control point
+    or, with mode = "dynamic", one file for the whole sequence (N_controlpoints x 2 x N_pairs).
+    """
+
+    geometry = (setup["leaf_stl_path"], setup["number_of_leaf_pairs"], \
+        setup["dist_from_xy_plane_to_top_edge"], setup["MLC_TransZ"])
+
+    if mode == "dynamic":
+        CreateTopasMLCFile(filenames[0], *geometry, TransX, mode = mode, overrides = overrides, \
+            leaf_pitch = setup["leaf_pitch"], profile = setup.get("profile"))
+        return
+
+    for filename, transx in zip(filenames, TransX):
+        CreateTopasMLCFile(filename, *geometry, transx.tolist(), mode = mode, overrides = overrides, \
+            leaf_pitch = setup["leaf_pitch"], profile = setup.get("profile"))
+
+    return
+
+def write_variants(leaf_positions, number_of_variants, errors, setup, output_dir = "variants", \
+    seed = 0, mode = "static", workers = 1):
+
+    """
+    A function that samples number_of_variants perturbed variants of a leaf position
+    sequence (N_controlpoints x N_pairs x 2), see sample_perturbations(), and writes their
+    simulation files into output_dir (variant_00000.txt, ... or variant_00000_0000.txt, ...
+    for sequences). With workers > 1 the variants are written by a process pool. All
+    sampled errors are saved to output_dir/perturbations.npz and a manifest.json maps the
+    files of every variant to its perturbation parameters. Returns the manifest.
+    """
+
+    leaf_positions = np.asarray(leaf_positions, dtype = float).reshape(-1, setup["number_of_leaf_pairs"], 2)
+    number_of_controlpoints = len(leaf_positions)
+
+    with stage("sample"):
+        perturbations = sample_perturbations(number_of_variants, number_of_controlpoints, \
+            setup["number_of_leaf_pairs"], errors, seed)
+        positions = perturb(leaf_positions, perturbations)
+
+    with stage("transx"):
+        TransX = Projection.from_setup(setup).transx(positions)                                       #(N_variants x N_controlpoints x 2 x N_pairs)
+
+    layouts = bank_layouts(perturbations, setup["number_of_leaf_pairs"], setup["leaf_pitch"], setup.get("profile"))
+    overrides = [None]*number_of_variants if layouts is None else \
+        [{key: value[v] for key, value in layouts.items()} for v in range(number_of_variants)]
+
+    os.makedirs(output_dir, exist_ok = True)
+    files = [output_filenames(os.path.join(output_dir, "variant_{:05d}.txt".format(v)), \
+        1 if mode == "dynamic" else number_of_controlpoints) for v in range(number_of_variants)]
+
+    writer = partial(write_variant, setup = setup, mode = mode)
+
+    if workers > 1 and number_of_variants > 1:                                                        #Fan the variants out over a process pool
+        from concurrent.futures import ProcessPoolExecutor                                            #Imported here, it is the slowest import of a single-process run
+        with stage("pool"), ProcessPoolExecutor(max_workers = workers) as executor:
+            list(executor.map(writer, files, TransX, overrides, chunksize = max(1, number_of_variants//(4*workers))))
+
+    else:
+        for filenames, transx, override in zip(files, TransX, overrides):
+            writer(filenames, transx, override)
+
+    np.savez_compressed(os.path.join(output_dir, "perturbations.npz"), positions = positions, **perturbations)
+
+    manifest = {"number_of_variants": number_of_variants, "number_of_controlpoints": number_of_controlpoints, \
+        "seed": seed, "mode": mode, "errors": errors, "perturbations": "perturbations.npz", "variants": []}
+
+    for v in range(number_of_variants):
+        leaf = perturbations["leaf"][v]
+        manifest["variants"] += [{"variant": v, "files": files[v], "shift": perturbations["shift"][v].tolist(), \
+            "gap": float(perturbations["gap"][v]), "tilt": perturbations["tilt"][v].tolist(), \
+            "height": perturbations["height"][v].tolist(), "leaf_rms": float(np.sqrt(np.mean(leaf**2))), \
+            "leaf_max": float(np.abs(leaf).max())}]
+
+    with open(os.path.join(output_dir, "manifest.json"), "w") as file:
+        json.dump(manifest, file, indent = 2)
+
+    return manifest
+
+def main(argv = None):
+
+    """
+    Command line entry point: writes perturbed variants of a plan for robustness analyses.
+    """
+
+    parser = argparse.ArgumentParser(description = "Create TOPAS MLC files of randomly perturbed plan variants.")
+    parser.add_argument("input", help = "stacked .txt, .npy/.npz file, RT Plan (.dcm) or directory of leaf positions")
+    parser.add_argument("variants", type = int, help = "number of variants")
+    parser.add_argument("-o", "--output-dir", default = "variants")
+    parser.add_argument("-w", "--workers", type = int, default = 1, help = "number of worker processes")
+    parser.add_argument("-m", "--mode", default = "static", choices = ["static", "dynamic", "merged"])
+    parser.add_argument("--seed", type = int, default = 0)
+    parser.add_argument("-e", "--errors", help = ".json file mapping error types to distributions")
+    parser.add_argument("-p", "--profile", help = "machine profile (name or .json file) with the leaf layout")
+    parser.add_argument("--shift", type = float, help = "standard deviation of the bank shift (cm)")
+    parser.add_argument("--gap", type = float, help = "standard deviation of the gap error (cm)")
+    parser.add_argument("--leaf", type = float, help = "standard deviation of the random leaf error (cm)")
+    parser.add_argument("--tilt", type = float, help = "standard deviation of the bank tilt (deg)")
+    parser.add_argument("--height", type = float, help = "standard deviation of the vertical bank shift (cm)")
+    args = parser.parse_args(argv)
+
+    if not os.path.exists(args.input):
+        parser.error("No such file or directory: " + args.input)
+
+    errors = {}
+
+    if args.errors is not None:
+        with open(args.errors) as file:
+            errors = json.load(file)
+
+    errors.update({name: getattr(args, name) for name in error_types if getattr(args, name) is not None})
+
+    setup = machine_setup()
+
+    if args.profile is not None:                                                                      #The profile also defines the number of leaf pairs
+        setup = dict(setup, profile = args.profile, number_of_leaf_pairs = len(compile_profile(args.profile)["TransY"]))
+
+    leaf_positions = load_control_points(args.input, setup["number_of_leaf_pairs"])
+
+    if leaf_positions.shape[1] != setup["number_of_leaf_pairs"]:
+        parser.error("Expected {} leaf pairs, found {}".format(setup["number_of_leaf_pairs"], leaf_positions.shape[1]))
+
+    manifest = write_variants(leaf_positions, args.variants, errors, setup, args.output_dir, \
+        args.seed, args.mode, args.workers)
+
+    print("{} variants written to {}".format(manifest["number_of_variants"], args.output_dir))
+
+    return
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+"""
+Stage-level timing and memory reports of the generation pipeline.
+"""
+
+import os
+import sys
+import json
+import time
+import atexit
+import tracemalloc
+
+
+environment_variable = "TOPAS_MLC_PROFILE"                                                            #"1": timings, "memory": timings and allocations
+report_variable = "TOPAS_MLC_PROFILE_REPORT"                                                          #Optional .json file for the report at exit
+
+enabled = False
+memory = False
+
+_stats = {}                                                                                           #{stage: [calls, seconds, self seconds, peak bytes or None]}
+_stack = []
+
+class _Disabled:
+
+    """
+    Stage used while profiling is disabled, does nothing.
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        return False
+
+_disabled = _Disabled()
+
+class _Stage:
+
+    """
+    Stage that adds its run time and peak allocation to the statistics. Time spent in
+    nested stages is excluded from the self time of the enclosing stage.
+    """
+
+    def __init__(self, name):
+
+        self.name = name
+
+    def __enter__(self):
+
+        self.current = 0
+        self.peak = 0
+        self.children = 0
+
+        if memory:
+            self.current, peak = tracemalloc.get_traced_memory()
+            if _stack:                                                                                #Keep the peak of the enclosing stage before resetting it
+                _stack[-1].peak = max(_stack[-1].peak, peak - _stack[-1].current)
+            tracemalloc.reset_peak()
+
+        _stack.append(self)
+        self.start = time.perf_counter()
+
+        return self
+
+    def __exit__(self, *exception):
+
+        seconds = time.perf_counter() - self.start
+        _stack.pop()
+
+        if memory:
+            peak = tracemalloc.get_traced_memory()[1]
+            self.peak = max(self.peak, peak - self.current)
+            if _stack:
+                _stack[-1].peak = max(_stack[-1].peak, peak - _stack[-1].current)
+            tracemalloc.reset_peak()
+
+        if _stack:
+            _stack[-1].children += seconds
+
+        stats = _stats.setdefault(self.name, [0, 0., 0., None])
+        stats[0] += 1
+        stats[1] += seconds
+        stats[2] += seconds - self.children
+
+        if memory:
+            stats[3] = max(stats[3] or 0, self.peak)
+
+        return False
+
+def stage(name):
+
+    """
+    A function that returns a context manager measuring one pipeline stage, e.g.
+    with stage("write"): ... Returns a shared no-op context while profiling is disabled.
+    """
+
+    return _Stage(name) if enabled else _disabled
+
+def enable(track_memory = False):
+
+    """
+    A function that enables profiling, with track_memory also of the peak allocations
+    (using tracemalloc, which slows Python allocations down noticeably).
+    """
+
+    global enabled, memory
+
+    enabled = True
+    memory = track_memory
+
+    if memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+    return
+
+def disable():
+
+    """
+    A function that disables profiling. The statistics are kept until reset().
+    """
+
+    global enabled, memory
+
+    if memory and tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+    enabled = False
+    memory = False
+
+    return
+
+def reset():
+
+    """
+    A function that removes all collected statistics.
+    """
+
+    _stats.clear()
+
+    return
+
+def report():
+
+    """
+    A function that returns the statistics of every stage as a dictionary, sorted by self time.
+    """
+
+    total = sum(stats[2] for stats in _stats.values())
+
+    return {name: {"calls": calls, "seconds": seconds, "self_seconds": self_seconds, \
+        "share": self_seconds/total if total else 0., "peak_memory": peak} \
+        for name, (calls, seconds, self_seconds, peak) in sorted(_stats.items(), key = lambda item: -item[1][2])}
+
+def format_report(stages = None):
+
+    """
+    A function that formats a report (see report()) as a readable table.
+    """
+
+    stages = report() if stages is None else stages
+
+    lines = ["{:<20}{:>10}{:>14}{:>14}{:>8}{:>12}".format("stage", "calls", "total (s)", "self (s)", "self", "peak (MiB)")]
+    lines += ["{:<20}{:>10}{:>14.6f}{:>14.6f}{:>7.1f}%{:>12}".format(name, s["calls"], s["seconds"], s["self_seconds"], \
+        100*s["share"], "-" if s["peak_memory"] is None else "{:.2f}".format(s["peak_memory"]/2**20)) \
+        for name, s in stages.items()]
+
+    return "\n".join(lines)
+
+def save_report(path, stages = None):
+
+    """
+    A function that saves a report (see report()) as .json file.
+    """
+
+    with open(path, "w") as file:
+        json.dump(report() if stages is None else stages, file, indent = 2)
+
+    return
+
+def _report_at_exit():
+
+    """
+    A function that prints the report of profiling enabled by the environment variable.
+    """
+
+    if enabled and _stats:
+        print(format_report(), file = sys.stderr)
+        if os.environ.get(report_variable):
+            save_report(os.environ[report_variable])
+
+    return
+
+if os.environ.get(environment_variable, "") not in ("", "0"):                                        #Enabled for every process using the tool, e.g. cluster jobs
+    enable(os.environ[environment_variable].lower() == "memory")
+    atexit.register(_report_at_exit)
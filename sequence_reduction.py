@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""
+Merging and resampling of control point sequences.
+"""
+
+import numpy as np
+
+
+def merge_similar(leaf_positions, weights = None, tolerance = 0.05, window = 256):
+
+    """
+    A function that merges consecutive control points (N_controlpoints x N_pairs x 2) whose
+    leaves all lie within tolerance of the first control point of their segment. The merged
+    positions are the weighted mean of the segment and the weights are summed. Returns the
+    merged positions, the merged weights and the index of the merged segment for every
+    original control point.
+    """
+
+    positions = np.asarray(leaf_positions, dtype = float)
+    weights = np.ones(len(positions)) if weights is None else np.asarray(weights, dtype = float)
+
+    mapping = np.empty(len(positions), dtype = int)
+    segment, start = 0, 0
+
+    while start < len(positions):
+        end = start + 1
+
+        while end < len(positions):                                                                   #Compare the following control points in windows
+            deviation = np.abs(positions[end:end+window] - positions[start]).max(axis = (1, 2))
+            outside = np.flatnonzero(deviation > tolerance)
+
+            if len(outside):
+                end += outside[0]
+                break
+            end += len(deviation)
+
+        mapping[start:end] = segment
+        segment, start = segment + 1, end
+
+    merged_weights = np.bincount(mapping, weights)
+    summed = np.zeros((segment,) + positions.shape[1:])
+    np.add.at(summed, mapping, positions*weights[:, np.newaxis, np.newaxis])
+
+    with np.errstate(divide = "ignore", invalid = "ignore"):                                          #Segments without weight keep their first control point
+        merged = np.where(merged_weights[:, np.newaxis, np.newaxis] > 0, \
+            summed/merged_weights[:, np.newaxis, np.newaxis], positions[np.searchsorted(mapping, np.arange(segment))])
+
+    return merged, merged_weights, mapping
+
+def resample(leaf_positions, number_of_segments, weights = None):
+
+    """
+    A function that resamples a control point sequence (N_controlpoints x N_pairs x 2) to
+    number_of_segments segments of equal weight. Leaf positions are interpolated linearly
+    over the cumulative weight (meterset) at the centre of each segment. Returns the
+    resampled positions, their weights and the index of the new segment for every
+    original control point.
+    """
+
+    positions = np.asarray(leaf_positions, dtype = float)
+    weights = np.ones(len(positions)) if weights is None else np.asarray(weights, dtype = float)
+
+    cumulative = np.cumsum(weights) - weights/2                                                       #Meterset at the centre of each control point
+    total = weights.sum()
+    samples = (np.arange(number_of_segments) + 0.5)*total/number_of_segments
+
+    upper = np.minimum(np.searchsorted(cumulative, samples), len(positions)-1)
+    lower = np.maximum(upper - 1, 0)
+    span = cumulative[upper] - cumulative[lower]
+
+    with np.errstate(divide = "ignore", invalid = "ignore"):
+        fraction = np.clip(np.where(span > 0, (samples - cumulative[lower])/span, 0), 0, 1)
+
+    fraction = fraction[:, np.newaxis, np.newaxis]
+    resampled = (1-fraction)*positions[lower] + fraction*positions[upper]                             #Linear interpolation of all leaves at once
+
+    mapping = np.minimum((cumulative*number_of_segments/total).astype(int), number_of_segments-1)
+
+    return resampled, np.full(number_of_segments, total/number_of_segments), mapping
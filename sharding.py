@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""
+Splitting control point sequences into cluster shards of equal simulation cost.
+"""
+
+import os
+import sys
+import json
+import argparse
+import numpy as np
+from mlc_core import machine_setup, load_control_points, Projection, CreateTopasMLCFile
+
+
+def plan_shards(weights, number_of_shards, histories_per_mu, overhead = 0):
+
+    """
+    A function that distributes the histories of a control point sequence over
+    number_of_shards shards of equal simulation cost. Every control point needs
+    round(weight*histories_per_mu) histories, plus overhead (in histories) for setting up
+    its geometry. The sequence is cut into contiguous shards of equal cost; a control
+    point crossing a shard boundary is split between both shards. Returns the histories
+    of every control point in every shard (N_controlpoints x number_of_shards).
+    """
+
+    weights = np.asarray(weights, dtype = float)
+    histories = np.round(weights*histories_per_mu).astype(np.int64)
+    cost = np.where(histories > 0, histories + overhead, 0).astype(float)                             #Control points without histories are not simulated
+
+    end = np.cumsum(cost)
+    start = end - cost
+    bounds = np.arange(1, number_of_shards+1)*end[-1]/number_of_shards if len(end) else np.zeros(number_of_shards)
+
+    with np.errstate(divide = "ignore", invalid = "ignore"):                                          #Part of every control point done at the end of every shard
+        done = np.clip((bounds - start[:, np.newaxis])/cost[:, np.newaxis], 0, 1)
+    done = np.nan_to_num(done)
+
+    cumulative = np.round(done*histories[:, np.newaxis]).astype(np.int64)
+    cumulative[:, -1] = histories                                                                     #All histories are assigned in the last shard at the latest
+
+    return np.diff(cumulative, axis = 1, prepend = 0)
+
+def write_shards(TransX, weights, number_of_shards, histories_per_mu, setup, output_dir = "shards", \
+    overhead = 0, seed = 1):
+
+    """
+    A function that plans the shards (see plan_shards()) for a TransX sequence
+    (N_controlpoints x 2 x N_pairs) and writes the geometry files of every shard into
+    output_dir/shard_000, ... together with a runs.txt file listing file, histories and
+    seed of every run. A manifest.json for the later dose summation maps every run to its
+    control point, histories, MU and seed. Returns the manifest.
+    """
+
+    plan = plan_shards(weights, number_of_shards, histories_per_mu, overhead)
+    weights = np.asarray(weights, dtype = float)
+
+    manifest = {"number_of_shards": number_of_shards, "histories_per_mu": histories_per_mu, \
+        "overhead": overhead, "total_histories": int(plan.sum()), "total_mu": float(weights.sum()), "shards": []}
+
+    run = 0
+
+    for shard in range(number_of_shards):
+        directory = os.path.join(output_dir, "shard_{:03d}".format(shard))
+        os.makedirs(directory, exist_ok = True)
+
+        runs = []
+
+        for controlpoint in np.flatnonzero(plan[:, shard]):
+            filename = os.path.join(directory, "MLC_CP{:04d}.txt".format(controlpoint))
+            CreateTopasMLCFile(filename, setup["leaf_stl_path"], setup["number_of_leaf_pairs"], \
+                setup["dist_from_xy_plane_to_top_edge"], setup["MLC_TransZ"], TransX[controlpoint].tolist(), \
+                leaf_pitch = setup["leaf_pitch"], profile = setup.get("profile"))
+
+            histories = int(plan[controlpoint, shard])
+            runs += [{"controlpoint": int(controlpoint), "file": filename, "histories": histories, \
+                "mu": histories/histories_per_mu, "seed": seed + run}]
+            run += 1
+
+        with open(os.path.join(directory, "runs.txt"), "w") as file:
+            file.write("".join("{} {} {}\n".format(r["file"], r["histories"], r["seed"]) for r in runs))
+
+        manifest["shards"] += [{"shard": shard, "directory": directory, \
+            "histories": int(plan[:, shard].sum()), "cost": int(plan[:, shard].sum()) + overhead*len(runs), "runs": runs}]
+
+    with open(os.path.join(output_dir, "manifest.json"), "w") as file:
+        json.dump(manifest, file, indent = 2)
+
+    return manifest
+
+def main(argv = None):
+
+    """
+    Command line entry point: splits a plan into balanced shards for a computing cluster.
+    """
+
+    parser = argparse.ArgumentParser(description = "Split a control point sequence into balanced TOPAS jobs.")
+    parser.add_argument("input", help = "stacked .txt, .npy/.npz file, RT Plan (.dcm) or directory of leaf positions")
+    parser.add_argument("shards", type = int, help = "number of shards")
+    parser.add_argument("-n", "--histories-per-mu", type = float, default = 1e5, help = "histories per MU")
+    parser.add_argument("-w", "--weights", help = "text file with the MU of every control point (default: RT Plan MU or 1 MU each)")
+    parser.add_argument("--overhead", type = float, default = 0, help = "geometry setup cost of a run, in histories")
+    parser.add_argument("--seed", type = int, default = 1, help = "seed of the first run")
+    parser.add_argument("-o", "--output-dir", default = "shards")
+    args = parser.parse_args(argv)
+
+    setup = machine_setup()
+    leaf_positions, weights = load_control_points(args.input, setup["number_of_leaf_pairs"], return_weights = True)
+
+    if args.weights is not None:                                                                      #Overrides the MU of an RT Plan
+        weights = np.loadtxt(args.weights, ndmin = 1)
+    elif weights is None:
+        weights = np.ones(len(leaf_positions))
+
+    TransX = Projection.from_setup(setup).transx(leaf_positions)                                      #Same conversion as load_mlc_data()
+
+    manifest = write_shards(TransX, weights, args.shards, args.histories_per_mu, setup, args.output_dir, \
+        args.overhead, args.seed)
+
+    for shard in manifest["shards"]:
+        print("{directory}: {histories} histories in {runs} runs".format(directory = shard["directory"], \
+            histories = shard["histories"], runs = len(shard["runs"])))
+
+    return
+
+if __name__ == "__main__":
+    sys.exit(main())